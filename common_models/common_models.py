@@ -1,5 +1,12 @@
 import rest_client
-from xml.etree import ElementTree as et
+import array as _array, calendar as _calendar, inspect as _inspect
+
+numpy_available = False
+try:
+    import numpy as _numpy
+    numpy_available = True
+except:
+    pass
 
 class ModelManager(object):
     """Handles what can be queried for, and acts as the entry point for querying.  There is an instance per model that is used
@@ -31,17 +38,15 @@ class ModelManager(object):
 
 
 class ModelQuery(object):
+    _only = None
+    _defer = ()
 
     def __init__(self, manager, model, headers={}):
         self.manager = manager
         self.model = model
         self.args = {}
         self.headers = headers
-        if 'xml_models' in str(model.__class__):
-            self._fragments = self._xml_fragments
-        elif 'json_models' in str(model.__class__):
-            self._fragments = self._json_fragments
-        else:
+        if 'xml_models' not in str(model.__class__) and 'json_models' not in str(model.__class__):
             raise NonSupportedModelError
 
     def filter(self, **kw):
@@ -53,21 +58,78 @@ class ModelQuery(object):
         self.custom_url = url
         return self
 
+    def only(self, *fields):
+        """Reads just the named fields of each result as the response is streamed, keeping no document.  Reading
+        any other field of a result raises DeferredFieldError, so validate_on_load, which is run on each result,
+        must only read the fields named."""
+        self._only = fields
+        return self
+
+    def defer(self, *fields):
+        """Reads every field of each result except those named as the response is streamed, keeping no document.
+        Reading a deferred field of a result raises DeferredFieldError, so validate_on_load, which is run on each
+        result, must not read the fields named."""
+        self._defer = self._defer + fields
+        return self
+
     def count(self):
         response = rest_client.Client("").GET(self._find_query_path(), headers=self.headers)
         count = 0
-        for x in self._fragments(response.content):
+        for document in self.model._documents(response.content):
             count += 1
         return count
 
     def __iter__(self):
+        plan = self._projection()
         response = rest_client.Client("").GET(self._find_query_path(), headers=self.headers)
-        for fragment in self._fragments(response.content):
-            yield self.model(fragment)
+        for document in self.model._documents(response.content):
+            if plan is None:
+                yield self.model._from_document(document)
+            else:
+                values = self.model._extract(document, plan)
+                yield self.model._from_values(dict((field._name, value) for field, value in zip(plan, values)))
 
     def __len__(self):
         return self.count()
 
+    def values(self, *fields):
+        """Returns an iterator over the results as dicts, mapping each of the named fields, or every field if none are
+        named, to its value.  The values are read straight from the response without building a model per result."""
+        plan = self._plan(fields)
+        names = [field._name for field in plan]
+        return (dict(zip(names, row)) for row in self._rows(plan))
+
+    def values_list(self, *fields, **kw):
+        """Like values(), but returns each result as a tuple of the values of the fields in the order named, or just
+        the value of the one field named if flat=True."""
+        flat = kw.pop('flat', False)
+        if kw:
+            raise TypeError("Unexpected keyword arguments to values_list: %s" % kw.keys())
+        if flat and len(fields) != 1:
+            raise TypeError("values_list(flat=True) takes exactly one field")
+        rows = self._rows(self._plan(fields))
+        if flat:
+            return (row[0] for row in rows)
+        return (tuple(row) for row in rows)
+
+    def to_columns(self, fields, numpy=False, missing=None):
+        """Returns a dict mapping each of the named fields to a column holding its value for every result, read
+        straight from the response without building a model per result.  Int and Bool fields give array.array
+        columns of ints, and Float and Date fields give arrays of floats, with dates as POSIX timestamps (naive
+        dates are taken as UTC) and missing values as NaN.  An Int or Bool column with a missing value is returned as
+        floats, with NaN for each missing value, unless missing gives a value to store in its place.  Other fields
+        give lists.  If numpy is True, NumPy arrays are returned instead, with datetime64 columns for dates."""
+        if numpy and not numpy_available:
+            raise ImportError("to_columns(numpy=True) requires NumPy")
+        plan = [self.model._field(name) for name in fields]
+        columns = [FieldColumn(field, missing) for field in plan]
+        for row in self._rows(plan):
+            for column, value in zip(columns, row):
+                column.append(value)
+        if numpy:
+            return dict((name, column.to_numpy()) for name, column in zip(fields, columns))
+        return dict((name, column.values) for name, column in zip(fields, columns))
+
     def get(self, **kw):
         for key in kw.keys():
             self.args[key] = kw[key]
@@ -81,20 +143,23 @@ class ModelQuery(object):
             raise DoesNotExist(self.model, self.args)
         return self.model(content)
 
-    def _xml_fragments(self, xml):
-        tree = et.iterparse(xml, ['start','end'])
-        tree.next()
-        evt, child = tree.next()
-        node_name = child.tag
-        for event, elem in tree:
-            if event == 'end' and elem.tag == node_name:
-                result = et.tostring(elem)
-                elem.clear()
-                yield result
-
-    def _json_fragments(self, json):
-        for result in json.readlines():
-            yield result
+    def _plan(self, fields):
+        if not fields:
+            return list(self.model._fields)
+        return [self.model._field(name) for name in fields]
+
+    def _rows(self, plan):
+        response = rest_client.Client("").GET(self._find_query_path(), headers=self.headers)
+        for document in self.model._documents(response.content):
+            yield self.model._extract(document, plan)
+
+    def _projection(self):
+        if self._only is None and not self._defer:
+            return None
+        names = self._only
+        if names is None:
+            names = [field._name for field in self.model._fields]
+        return [self.model._field(name) for name in names if name not in self._defer]
 
     def _find_query_path(self):
         if hasattr(self, 'custom_url'):
@@ -108,6 +173,83 @@ class ModelQuery(object):
         except KeyError:
             raise NoRegisteredFinderError(str(key_tuple))
 
+_typecodes = {'IntField': 'l', 'BoolField': 'b', 'FloatField': 'd', 'DateField': 'd'}
+_dtypes = {'l': 'int_', 'b': 'bool_', 'd': 'float64'}
+
+class FieldColumn(object):
+    """Accumulates the values of one field for to_columns() and compact collections.  Missing values are stored as
+    missing, if it is given.  Otherwise they are NaN in float and date columns, and an int or bool column that meets
+    one is widened to a column of floats, with NaN for each missing value."""
+    def __init__(self, field, missing=None):
+        self.name = field._name
+        self.missing = missing
+        self.typecode = None
+        self.dates = False
+        for cls in _inspect.getmro(field.__class__):
+            if _typecodes.has_key(cls.__name__):
+                self.typecode = _typecodes[cls.__name__]
+                self.dates = cls.__name__ == 'DateField'
+                break
+        if self.typecode:
+            self.values = _array.array(self.typecode)
+        else:
+            self.values = []
+
+    def append(self, value):
+        if self.dates and value is not None:
+            value = _calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+        if value is None and self.typecode:
+            if self.missing is not None:
+                value = self.missing
+            else:
+                if self.typecode != 'd':
+                    self.typecode = 'd'
+                    self.values = _array.array('d', self.values)
+                value = float('nan')
+        try:
+            self.values.append(value)
+        except TypeError:
+            raise ValueError("%r is not a valid value for column %s" % (value, self.name))
+
+    def to_numpy(self):
+        if not self.typecode:
+            column = _numpy.empty(len(self.values), dtype=object)
+            column[:] = self.values
+            return column
+        column = _numpy.array(self.values, dtype=_dtypes[self.typecode])
+        if self.dates:
+            microseconds = _numpy.round(column * 1e6)
+            missing = _numpy.isnan(microseconds)
+            column = _numpy.where(missing, 0, microseconds).astype('int64').astype('datetime64[us]')
+            column[missing] = _numpy.datetime64('NaT')
+        return column
+
+class InternTable(object):
+    """Maps each distinct value of a field to the first object read with that value, so equal values read from many
+    documents share one object.  Once the table holds limit values, new values are no longer added."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.values = {}
+
+    def __call__(self, value):
+        try:
+            return self.values[value]
+        except KeyError:
+            if len(self.values) < self.limit:
+                self.values[value] = value
+            return value
+        except TypeError:
+            return value
+
+def intern_table(intern):
+    """Returns an InternTable for the intern keyword arg of a CharField: None if it is false, a table of up to 10000
+    values if it is True, or of up to intern values otherwise."""
+    if not intern:
+        return None
+    if intern is True:
+        intern = 10000
+    return InternTable(intern)
+
 class NoRegisteredFinderError(Exception):
     pass
 
@@ -117,6 +259,9 @@ class NonSupportedModelError(Exception):
 class ValidationError(Exception):
     pass
 
+class DeferredFieldError(Exception):
+    pass
+
 class DoesNotExist(Exception):
 
     def __init__(self, model, args):
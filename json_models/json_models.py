@@ -57,8 +57,15 @@ class BaseField:
         return value
 
 class CharField(BaseField):
+    def __init__(self, intern=False, **kw):
+        BaseField.__init__(self, **kw)
+        self._intern = intern_table(intern)
+
     def parse(self, json_data):
-        return self._parse(json_data)
+        value = self._parse(json_data)
+        if self._intern is not None and value is not None:
+            return self._intern(value)
+        return value
 
 class IntField(BaseField):
     def parse(self, json_data):
@@ -77,9 +84,12 @@ class DateField(BaseField):
         return value and (long)((time.mktime(value.utctimetuple()) - time.timezone) * 1000.0 + value.microsecond / 1000.0) or None
 
 class Collection(BaseField):
-    def __init__(self, field_type, order_by=None, **kw):
+    def __init__(self, field_type, order_by=None, intern=False, **kw):
         self.field_type = field_type
         self.order_by = order_by
+        if intern and not (hasattr(field_type, '__bases__') and issubclass(field_type, CharField)):
+            raise ValueError("Only collections of Char fields can intern their values")
+        self._intern = intern_table(intern)
         BaseField.__init__(self, **kw)
 
     def parse(self, json_data):
@@ -92,17 +102,26 @@ class Collection(BaseField):
                     results.append(self.field_type(json=match._json))
                 else:
                     results.append(self.field_type(json=match))
+        elif matches and self._intern is not None:
+            results = [self._intern(match) if match is not None else match for match in matches]
         elif matches:
             results = matches
         if self.order_by:
             results.sort(lambda a,b : cmp(getattr(a, self.order_by), getattr(b, self.order_by)))
         return results
 
+    def save(self, value):
+        if value is None:
+            return value
+        return [item._json if isinstance(item, Model) else item for item in value]
+
 CollectionField = Collection
 
 class ModelBase(type):
     def __init__(cls, name, bases, attrs):
         fields = [field_name for field_name in attrs.keys() if isinstance(attrs[field_name], BaseField)]
+        cls._fields = [field for base in bases for field in getattr(base, '_fields', []) if field._name not in fields]
+        cls._fields.extend(attrs[field_name] for field_name in fields)
         for field_name in fields:
             setattr(cls, field_name, cls._get_path(field_name, attrs[field_name]))
             attrs[field_name]._name = field_name
@@ -118,6 +137,7 @@ class ModelBase(type):
 
 class Model:
     __metaclass__ = ModelBase
+    _deferred = frozenset()
 
     def __init__(self,json_data=None,**kw):
         if kw.has_key('json'):
@@ -133,9 +153,71 @@ class Model:
         pass
 
     def _parse_field(self, field):
+        if field._name in self._deferred:
+            raise DeferredFieldError("%s was built by a query with only() or defer(), which did not read %s"
+                                     % (type(self).__name__, field._name))
         return field.parse(self._json)
 
+    @classmethod
+    def _field(cls, field_name):
+        for field in cls._fields:
+            if field._name == field_name:
+                return field
+        raise AttributeError(field_name)
+
+    @classmethod
+    def from_file(cls, source):
+        """Builds a model from source, a file object or file name.  The json module has no incremental parser, so
+        unlike xml models the whole file is read into memory before it is parsed."""
+        if isinstance(source, basestring):
+            with open(source) as stream:
+                return cls.from_file(stream)
+        try:
+            json_data = json.load(source)
+        except ValueError:
+            raise ValidationError("Invalid JSON")
+        return cls(json=json_data)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Builds a model from a document held in buffer, e.g. an mmap of a file, a bytearray or a memoryview.  The
+        json module only parses strings, so unlike xml models the document is copied into one first."""
+        text = buffer[:]
+        if hasattr(text, 'tobytes'):
+            text = text.tobytes()
+        try:
+            json_data = json.loads(str(text))
+        except ValueError:
+            raise ValidationError("Invalid JSON")
+        return cls(json=json_data)
+
+    @classmethod
+    def _documents(cls, stream):
+        return stream.readlines()
+
+    @classmethod
+    def _from_document(cls, document):
+        return cls(document)
+
+    @classmethod
+    def _from_values(cls, values):
+        model = cls.__new__(cls)
+        model._json = AttrDict()
+        for name, value in values.items():
+            model._set_field(cls._field(name), value)
+        model._deferred = frozenset(field._name for field in cls._fields if field._name not in values)
+        model.validate_on_load()
+        return model
+
+    @classmethod
+    def _extract(cls, fragment, fields):
+        """Returns the values of the fields read from a json string, without building a model."""
+        json_data = AttrDict(json.loads(fragment))
+        return [field.parse(json_data) for field in fields]
+
     def _set_field(self, field, value):
+        if field._name in self._deferred:
+            self._deferred = self._deferred - frozenset([field._name])
         value = field.save(value)
         nodes = field.path.split('.')
         self.set_nested_value(self._json,nodes, value)
@@ -147,6 +229,15 @@ class Model:
         else:
             setattr(data,node, value)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_json'] = json.dumps(self._json, separators=(',',':'))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._json = AttrDict(json.loads(self._json))
+
     def __unicode__(self):
         return json.dumps(self._json,separators=(',',':'))
 
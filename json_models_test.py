@@ -26,7 +26,7 @@ authors and should not be interpreted as representing official policies, either
 or implied, of the FreeBSD Project.
 """
 
-import unittest, json
+import unittest, json, array, pickle, mmap, tempfile
 from datetime import datetime
 from mock import patch
 from StringIO import StringIO
@@ -199,6 +199,38 @@ class JsonModelsTest(unittest.TestCase):
         my_model.muppet_name = "Kermit"
         self.assertEquals("Kermit", my_model.muppet_name)
 
+    def test_model_pickles_as_compact_json(self):
+        my_model = MyModel('{"kiddie": {"value": "Gonzo", "opened": 123456}}')
+        my_model.muppet_type = 'bear'
+        restored = pickle.loads(pickle.dumps(my_model, 2))
+        self.assertEquals('Gonzo', restored.muppet_name)
+        self.assertEquals('bear', restored.muppet_type)
+        self.assertTrue(isinstance(restored._json.kiddie, AttrDict))
+
+    def test_model_can_be_built_from_a_file_or_buffer(self):
+        self.assertEquals('Gonzo', MyModel.from_file(StringIO('{"kiddie": {"value": "Gonzo"}}')).muppet_name)
+        self.assertEquals('Rowlf', MyModel.from_buffer(bytearray('{"kiddie": {"value": "Rowlf"}}')).muppet_name)
+        with tempfile.TemporaryFile() as stream:
+            stream.write('{"kiddie": {"value": "Kermit"}}')
+            stream.flush()
+            buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            self.assertEquals('Kermit', MyModel.from_buffer(buffer).muppet_name)
+            buffer.close()
+        self.assertRaises(ValidationError, MyModel.from_file, StringIO('{"kiddie":'))
+
+    def test_interned_char_fields_share_equal_values(self):
+        class Status(Model):
+            code = CharField(path='code', intern=True)
+        first, second = Status('{"code": "ACTIVE"}'), Status('{"code": "ACTIVE"}')
+        self.assertTrue(first.code is second.code)
+
+    def test_collections_of_char_fields_can_intern_their_values(self):
+        class Tagged(Model):
+            tags = Collection(CharField, path='tags', intern=True)
+        first, second = Tagged('{"tags": ["new", "sale"]}'), Tagged('{"tags": ["sale"]}')
+        self.assertTrue(first.tags[1] is second.tags[0])
+        self.assertRaises(ValueError, Collection, IntField, path='counts', intern=True)
+
     def test_can_set_datefield_to_model(self):
         my_model = MyModel('{"kiddie":{"opened":123456}}')
         my_model.opened = datetime(1980,1,1,0,0,0,135000)
@@ -351,6 +383,55 @@ class JsonModelsTest(unittest.TestCase):
         self.assertEquals("hello", results[0].field1)
         self.assertEquals("goodbye", results[1].field1)
 
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_exports_columns_of_field_values(self, mock_get):
+        class t:
+            content = StringIO('{"number": 12, "street": "Early Drive"}\n{"number": 5, "street": "Sesame St."}')
+        mock_get.return_value = t()
+        columns = Address.objects.filter(number=12).to_columns(['number', 'street'])
+        self.assertEquals(array.array('l', [12, 5]), columns['number'])
+        self.assertEquals(['Early Drive', 'Sesame St.'], columns['street'])
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_streams_rows_of_field_values(self, mock_get):
+        class t:
+            content = StringIO('{"number": 12, "street": "Early Drive"}\n{"number": 5, "street": "Sesame St."}')
+        mock_get.return_value = t()
+        rows = [row for row in Address.objects.filter(number=12).values('number', 'street')]
+        self.assertEquals([{'number': 12, 'street': 'Early Drive'}, {'number': 5, 'street': 'Sesame St.'}], rows)
+        t.content.seek(0)
+        self.assertEquals([12, 5], [number for number in Address.objects.filter(number=12).values_list('number', flat=True)])
+
+    @patch.object(rest_client.Client, "GET")
+    def test_only_reads_the_named_fields(self, mock_get):
+        class t:
+            content = StringIO('{"number": 12, "street": "Early Drive"}\n{"number": 5, "street": "Sesame St."}')
+        mock_get.return_value = t()
+        addresses = [address for address in Address.objects.filter(number=12).only('number')]
+        self.assertEquals([12, 5], [address.number for address in addresses])
+        self.assertEquals({'number': 12}, addresses[0]._json)
+        self.assertRaises(DeferredFieldError, getattr, addresses[0], 'street')
+        addresses[0].street = 'Fraggle Rock'
+        self.assertEquals('Fraggle Rock', addresses[0].street)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_only_validates_each_result(self, mock_get):
+        class t:
+            content = StringIO('{"kiddie": {"value": "Gonzo"}}\n{"kiddie": {}}')
+        mock_get.return_value = t()
+        results = iter(MyValidatingModel.objects.filter(muppet_name="Gonzo").only('muppet_name'))
+        self.assertEquals('Gonzo', results.next().muppet_name)
+        self.assertRaises(ValidationError, results.next)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_defer_reads_all_but_the_named_fields(self, mock_get):
+        class t:
+            content = StringIO('{"number": 12, "street": "Early Drive"}')
+        mock_get.return_value = t()
+        address = [address for address in Address.objects.filter(number=12).defer('number')][0]
+        self.assertEquals('Early Drive', address.street)
+        self.assertRaises(DeferredFieldError, getattr, address, 'number')
+
     @patch.object(rest_client.Client, "GET")
     def test_manager_returns_count_of_collection_of_results_when_len_is_called(self, mock_get):
         class t:
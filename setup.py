@@ -8,6 +8,6 @@ setup(name='xml_models',
       author='Chris Tarttelin and Cam McHugh',
       author_email='chris@pyruby.com',
       url='http://djangorestmodel.sourceforge.net/',
-      packages=['rest_client', 'xml_models', 'json_models','common_models'],
-      install_requires=['mock', 'py-dom-xpath']
+      packages=['rest_client', 'xml_models', 'json_models','common_models', 'xpath'],
+      install_requires=['mock']
      )
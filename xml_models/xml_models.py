@@ -31,8 +31,11 @@ to xml, and specifying finders that map to a remote REST service.  For parsing X
 XPath expressions, xml_models attempts to use lxml if it is available.  If not, it 
 uses pyxml_xpath.  Better performance will be gained by installing lxml."""
 
-import re, datetime, time
+import re, datetime, time, copy, json
+from collections import deque
 import xpath_twister as xpath
+import rest_client
+from xpath import parallel
 from common_models import *
 
 
@@ -41,99 +44,192 @@ class XmlValidationError(Exception):
 
 class BaseField:
     """All fields must specify an xpath as a keyword arg in their constructor.  Fields may optionally specify a 
-    default value using the default keyword arg."""
+    default value using the default keyword arg.  The xpath may refer to variables, e.g. $kind, whose values are
+    given by the variables keyword arg, or supplied when reading the field with Model.field_value().
+
+    Fields holding a single value implement to_python(), converting the string found by the xpath (or the default,
+    if nothing was found) to the field's type, which lets models read several such fields in one pass, and to_xml(),
+    converting a value back to the string written into the document when the model is saved."""
     def __init__(self, **kw):
         if not kw.has_key('xpath'):
             raise Exception('No XPath supplied for xml field')
         self.xpath = kw['xpath']
         self._default = kw.pop('default', None)
+        self.variables = kw.pop('variables', {})
             
     
     def _fetch_by_xpath(self, xml_doc, namespace):
-        find = xpath.find_unique(xml_doc, self.xpath, namespace)
+        find = xpath.find_unique(xml_doc, self.xpath, namespace, **self.variables)
         if find == None:
             return self._default
         return find
 
-    
-    def _parse(self, xml, namespace):
-        try:
-            return self.__cached_value
-        except:
-            self.__cached_value = self.parse(xml, namespace)
-            return self.__cached_value
+    def parse(self, xml, namespace):
+        return self.to_python(self._fetch_by_xpath(xml, namespace))
+
+    def to_xml(self, value):
+        if value is None:
+            return None
+        return unicode(value)
+
+def _reads_text(field):
+    """True if the value of the field is its to_python() of the text found by its xpath, so that it can be read along
+    with other fields, rather than through a parse() or _fetch_by_xpath() the field's class overrides."""
+    cls = field.__class__
+    return (hasattr(field, 'to_python') and cls.parse.im_func is BaseField.parse.im_func
+            and cls._fetch_by_xpath.im_func is BaseField._fetch_by_xpath.im_func)
     
 class CharField(BaseField):
-    """Returns the single value found by the xpath expression, as a string"""
-    def parse(self, xml, namespace):
-        return self._fetch_by_xpath(xml, namespace)
+    """Returns the single value found by the xpath expression, as a string.  If the intern keyword arg is True, equal
+    values are returned as one shared string, which saves memory for fields with few distinct values, e.g. status or
+    currency codes, read from many documents.  Up to 10000 distinct values are shared, or as many as intern gives."""
+    def __init__(self, intern=False, **kw):
+        BaseField.__init__(self, **kw)
+        self._intern = intern_table(intern)
+
+    def to_python(self, value):
+        if self._intern is not None and value is not None:
+            return self._intern(value)
+        return value
 
 class IntField(BaseField):
     """Returns the single value found by the xpath expression, as an int"""
-    def parse(self, xml, namespace):
-        value = self._fetch_by_xpath(xml, namespace)
+    def to_python(self, value):
         if value:
             return int(value)
         return self._default
     
+class FixedOffset(datetime.tzinfo):
+    """A fixed offset from UTC, given in minutes"""
+    def __init__(self, minutes):
+        self._minutes = minutes
+        self._offset = datetime.timedelta(minutes=minutes)
+
+    def __getinitargs__(self):
+        return (self._minutes,)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        sign = self._minutes < 0 and '-' or '+'
+        return '%s%02d:%02d' % ((sign,) + divmod(abs(self._minutes), 60))
+
+    def __repr__(self):
+        return 'FixedOffset(%d)' % self._minutes
+
+_offsets = {}
+
+def _fixed_offset(offset):
+    """Returns the FixedOffset for an ISO-8601 offset, e.g. Z, +02:00 or -0630.  No offset is taken as UTC."""
+    try:
+        return _offsets[offset]
+    except KeyError:
+        minutes = 0
+        if offset and offset != 'Z':
+            minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+            if offset[0] == '-':
+                minutes = -minutes
+        tz = _offsets[offset] = FixedOffset(minutes)
+        return tz
+
 class DateField(BaseField):
     """
     Returns the single value found by the xpath expression, as a datetime. By default, expects
-    dates that match the ISO date format (same as Java JAXB supplies).  If a date_format keyword
-    arg is supplied, that will be used instead.  Uses datetime.strptime under the hood, so the
-    date_format should be defined according to strptime rules.
+    dates that match the ISO date format (same as Java JAXB supplies), optionally with fractional
+    seconds and a UTC offset, which are parsed without going through strptime.  If a date_format
+    keyword arg is supplied, that will be used instead.  Uses datetime.strptime under the hood, so
+    the date_format should be defined according to strptime rules.
     
-    We sometimes get dates that include a UTC offset.  We don't have a nice way to handle these, 
-    so for now we are going to strip the offset and throw it away"""
-    match_utcoffset = re.compile(r"(^.*?)[+|-]\d{2}:\d{2}$")
+    By default the UTC offset is stripped and thrown away, giving a naive datetime in the local time
+    of the value.  If the tz_aware keyword arg is True, the offset is kept as the tzinfo of the
+    datetime, and values without an offset are taken to be in UTC."""
+    match_utcoffset = re.compile(r"(^.*?)([+|-]\d{2}:\d{2})$")
+    match_iso = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:[.,](\d{1,6})\d*)?(Z|[+-]\d\d:?\d\d)?$")
+    iso_format = "%Y-%m-%dT%H:%M:%S"
     
-    def __init__(self, date_format="%Y-%m-%dT%H:%M:%S", **kw):
+    def __init__(self, date_format=iso_format, tz_aware=False, **kw):
         BaseField.__init__(self,**kw)
         self.date_format = date_format
+        self.tz_aware = tz_aware
         
-    def parse(self, xml, namespace):
-        value = self._fetch_by_xpath(xml, namespace)
+    def to_python(self, value):
         if value:
-            utc_stripped = self.match_utcoffset.findall(value)
-            if len(utc_stripped) == 1:
-                value = utc_stripped[0]
-            try:
-                return datetime.datetime.strptime(value, self.date_format)
-            except ValueError, msg:
-                if "%S" in self.date_format:
-                    msg = str(msg)
+            return self.to_datetime(value)
+        return self._default
+
+    def to_datetime(self, value):
+        if self.date_format == self.iso_format:
+            match = self.match_iso.match(value)
+            if match is not None:
+                year, month, day, hour, minute, second, fraction, offset = match.groups()
+                microsecond = 0
+                if fraction:
+                    microsecond = int(fraction.ljust(6, '0'))
+                tzinfo = None
+                if self.tz_aware:
+                    tzinfo = _fixed_offset(offset)
+                return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                         microsecond, tzinfo)
+        offset = None
+        utc_stripped = self.match_utcoffset.match(value)
+        if utc_stripped is not None:
+            value, offset = utc_stripped.groups()
+        value = self._strptime(value)
+        if self.tz_aware:
+            value = value.replace(tzinfo=_fixed_offset(offset))
+        return value
+
+    def _strptime(self, value):
+        try:
+            return datetime.datetime.strptime(value, self.date_format)
+        except ValueError, msg:
+            if "%S" in self.date_format:
+                msg = str(msg)
+                rematch = re.match(r"unconverted data remains:"
+                    " \.([0-9]{1,6})$", msg)
+                if rematch is not None:
+                    frac = "." + rematch.group(1)
+                    value = value[:-len(frac)]
+                    value = datetime.datetime(*time.strptime(value, self.date_format)[0:6])
+                    microsecond = int(float(frac)*1e6)
+                    return value.replace(microsecond=microsecond)
+                else:
                     rematch = re.match(r"unconverted data remains:"
-                        " \.([0-9]{1,6})$", msg)
+                        " \,([0-9]{3,3})$", msg)
                     if rematch is not None:
                         frac = "." + rematch.group(1)
                         value = value[:-len(frac)]
                         value = datetime.datetime(*time.strptime(value, self.date_format)[0:6])
                         microsecond = int(float(frac)*1e6)
                         return value.replace(microsecond=microsecond)
-                    else:
-                        rematch = re.match(r"unconverted data remains:"
-                            " \,([0-9]{3,3})$", msg)
-                        if rematch is not None:
-                            frac = "." + rematch.group(1)
-                            value = value[:-len(frac)]
-                            value = datetime.datetime(*time.strptime(value, self.date_format)[0:6])
-                            microsecond = int(float(frac)*1e6)
-                            return value.replace(microsecond=microsecond)
-                raise
-        return self._default
+            raise
+
+    def to_xml(self, value):
+        if value is None:
+            return None
+        if self.date_format == self.iso_format:
+            return value.isoformat()
+        return value.strftime(self.date_format)
         
 class FloatField(BaseField):
     """Returns the single value found by the xpath expression, as a float"""
-    def parse(self, xml, namespace):
-        value = self._fetch_by_xpath(xml, namespace)
+    def to_python(self, value):
         if value:
             return float(value)
         return self._default
 
+    def to_xml(self, value):
+        if value is None:
+            return None
+        return repr(value)
+
 class BoolField(BaseField):
     """Returns the single value found by the xpath expression, as a boolean"""
-    def parse(self, xml, namespace):
-        value = self._fetch_by_xpath(xml, namespace)
+    def to_python(self, value):
         if value is not None:
             if value.lower() == 'true':
                 return True
@@ -141,48 +237,255 @@ class BoolField(BaseField):
                 return False
         return self._default
 
+    def to_xml(self, value):
+        if value is None:
+            return None
+        return value and u'true' or u'false'
+
 class Collection(BaseField):
     """Returns a collection found by the xpath expression.  Requires a field_type to be supplied, which can
     either be a field type, e.g. IntField, which returns a collection ints, or it can be a model type
-    e.g. Person may contain a collection of Address objects."""
-    def __init__(self, field_type, order_by=None, **kw):
+    e.g. Person may contain a collection of Address objects.  A collection of models is a LazyCollection, a list
+    which only builds the models that are used.  If order_by names a field of the model type, only that field is read
+    from each match to sort them.
+
+    Collections of Int, Float, Bool or Date fields may be compact, reading the text of every match with one xpath
+    and holding the values in an array.array, as ints for Int and Bool fields and floats for Float and Date fields,
+    with dates as POSIX timestamps (naive dates are taken as UTC) and missing floats as NaN.  Missing ints and bools
+    are stored as missing, if it is given, or else the array is widened to floats, with NaN for each missing value.
+    If numpy is True as well, the values are held in a NumPy array, with dates as datetime64.
+
+    Collections of Char fields may intern their values, as CharField does, with one table shared by every document
+    the collection is read from."""
+    def __init__(self, field_type, order_by=None, compact=False, numpy=False, missing=None, intern=False, **kw):
         self.field_type = field_type
         self.order_by = order_by
+        self.missing = missing
+        self.compact = compact or numpy
+        self.numpy = numpy
+        if intern and not (hasattr(field_type, '__bases__') and issubclass(field_type, CharField)):
+            raise ValueError("Only collections of Char fields can intern their values")
+        self._intern = intern_table(intern)
+        if self.compact and not issubclass(field_type, (IntField, FloatField, BoolField, DateField)):
+            raise ValueError("Only collections of Int, Float, Bool or Date fields can be compact")
+        if self.compact and not _reads_text(field_type(xpath='.')):
+            raise ValueError("Collections of fields that override parse() cannot be compact")
+        if numpy and not numpy_available:
+            raise ImportError("Collection(numpy=True) requires NumPy")
         BaseField.__init__(self,**kw)
         
     def parse(self, xml, namespace):
-        matches = xpath.find_all(xml, self.xpath, namespace)
+        if self.compact:
+            return self._parse_compact(xml, namespace)
+        matches = xpath.find_fragments(xml, self.xpath, namespace, **self.variables)
 
         if not BaseField in self.field_type.__bases__:
-            
-            results = [self.field_type(xml=match) for match in matches]
+            build = lambda match: _model(self.field_type, match)
         else:
-            field = self.field_type(xpath = '.')
-            results = [field.parse(xpath.domify(match), namespace) for match in matches]
+            field = self._item_field()
+            build = lambda match: field.parse(xpath.domify(match), namespace)
         if self.order_by:
-            results.sort(lambda a,b : cmp(getattr(a, self.order_by), getattr(b, self.order_by)))
-        return results
+            matches = self._sort(matches, build)
+        if BaseField in self.field_type.__bases__:
+            return [build(match) for match in matches]
+        return LazyCollection(matches, build)
+
+    def stream(self, source, namespace=None):
+        """Yields the values of the collection one at a time, parsed straight from source, a file object or file name
+        holding the whole document, which is never held in memory at once.  The xpath must be a plain path of named
+        child steps, and the values are yielded in document order, whatever order_by is."""
+        documents = xpath.iter_documents(source, self.xpath, namespace)
+        if not BaseField in self.field_type.__bases__:
+            return (_model(self.field_type, document) for document in documents)
+        field = self._item_field()
+        return (field.parse(document, None) for document in documents)
+
+    def _parse_compact(self, xml, namespace):
+        field = self._item_field()
+        field._name = self._name
+        column = FieldColumn(field, self.missing)
+        for value in xpath.find_values(xml, self.xpath, namespace, **self.variables):
+            column.append(field.to_python(value))
+        if self.numpy:
+            return column.to_numpy()
+        return column.values
+
+    def _item_field(self):
+        field = self.field_type(xpath='.')
+        if self._intern is not None:
+            field._intern = self._intern
+        return field
+
+    def _sort(self, matches, build):
+        key_fields = [field for field in getattr(self.field_type, '_fields', []) if field._name == self.order_by]
+        if key_fields:
+            matches = [xpath.domify(match) for match in matches]
+            namespace = getattr(self.field_type, 'namespace', None)
+            keys = [key_fields[0].parse(match, namespace) for match in matches]
+        else:
+            keys = [getattr(build(match), self.order_by) for match in matches]
+        order = sorted(xrange(len(matches)), key=keys.__getitem__)
+        return [matches[i] for i in order]
     
 CollectionField = Collection
 
+class LazyCollection(list):
+    """A list of the models matched by a Collection field, each of which is built from its match the first time it
+    is used.  Operations that need every model, e.g. sort, ==, + or repr, build them all first, after which the
+    collection behaves as a plain list.  Code in C that reads a list's items directly, e.g. str.join, sees
+    placeholders for the models not yet built, so such code should be given list(collection)."""
+    __slots__ = ('_matches', '_build')
+
+    def __init__(self, matches, build):
+        self._matches = list(matches)
+        self._build = build
+        list.__init__(self, [_unparsed] * len(self._matches))
+
+    def _item(self, index):
+        item = list.__getitem__(self, index)
+        if item is _unparsed:
+            item = self._build(self._matches[index])
+            list.__setitem__(self, index, item)
+            self._matches[index] = None
+        return item
+
+    def _fill(self):
+        if self._matches is not None:
+            for index in xrange(len(self)):
+                self._item(index)
+            self._matches = None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._item(i) for i in xrange(*index.indices(len(self)))]
+        return self._item(index)
+
+    def __getslice__(self, start, stop):
+        return self.__getitem__(slice(max(start, 0), max(stop, 0)))
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self._item(index)
+
+    def __reversed__(self):
+        for index in reversed(xrange(len(self))):
+            yield self._item(index)
+
+    def __setitem__(self, index, value):
+        if self._matches is not None:
+            if isinstance(index, slice):
+                value = list(value)
+                self._matches[index] = [None] * len(value)
+            else:
+                self._matches[index] = None
+        list.__setitem__(self, index, value)
+
+    def __setslice__(self, start, stop, values):
+        self.__setitem__(slice(max(start, 0), max(stop, 0)), values)
+
+    def __delitem__(self, index):
+        if self._matches is not None:
+            del self._matches[index]
+        list.__delitem__(self, index)
+
+    def __delslice__(self, start, stop):
+        self.__delitem__(slice(max(start, 0), max(stop, 0)))
+
+    def insert(self, index, value):
+        if self._matches is not None:
+            self._matches.insert(index, None)
+        list.insert(self, index, value)
+
+    def append(self, value):
+        if self._matches is not None:
+            self._matches.append(None)
+        list.append(self, value)
+
+    def extend(self, values):
+        values = list(values)
+        if self._matches is not None:
+            self._matches.extend([None] * len(values))
+        list.extend(self, values)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def pop(self, index=-1):
+        item = self._item(index)
+        del self[index]
+        return item
+
+    def reverse(self):
+        if self._matches is not None:
+            self._matches.reverse()
+        list.reverse(self)
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        self._fill()
+        return list.__add__(other, self)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+def _filled(method):
+    def filled(self, *args, **kw):
+        self._fill()
+        for arg in args:
+            if isinstance(arg, LazyCollection):
+                arg._fill()
+        return method(self, *args, **kw)
+    filled.__name__ = method.__name__
+    return filled
+
+for _name in ('__contains__', 'index', 'count', 'remove', 'sort', '__imul__', '__add__', '__mul__', '__rmul__',
+              '__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__', '__repr__'):
+    setattr(LazyCollection, _name, _filled(getattr(list, _name)))
+del _name
+
+def _model(model_type, fragment):
+    if isinstance(fragment, basestring):
+        return model_type(xml=fragment)
+    return model_type(dom=fragment)
+
 class OneToOneField(BaseField):
     def __init__(self, field_type, **kw):
         self.field_type = field_type
         BaseField.__init__(self,**kw)
         
     def parse(self, xml, namespace):
-        match = xpath.find_all(xml, self.xpath, namespace)
+        match = xpath.find_fragments(xml, self.xpath, namespace, **self.variables)
         if len(match) == 1:
-            return self.field_type(xml=match[0])
+            return _model(self.field_type, match[0])
         return None
         
 class ModelBase(type):
-    "Meta class for declarative xml_model building"
+    """Meta class for declarative xml_model building.  Model classes are given empty __slots__ unless they declare
+    their own, and the parsed value of each field, inherited fields included, is kept at a fixed position in the
+    model's _values list.  An inherited field that a class replaces with a method or other attribute is dropped."""
+    def __new__(meta, name, bases, attrs):
+        attrs.setdefault('__slots__', ())
+        return type.__new__(meta, name, bases, attrs)
+
     def __init__(cls, name, bases, attrs):
         xml_fields = [field_name for field_name in attrs.keys() if isinstance(attrs[field_name], BaseField)]
+        fields = {}
+        for base in reversed(cls.__mro__[1:]):
+            for field in getattr(base, '_fields', []):
+                fields[field._name] = field
         for field_name in xml_fields:
-            setattr(cls, field_name, cls._get_xpath(field_name, attrs[field_name]))
             attrs[field_name]._name = field_name
+            fields[field_name] = attrs[field_name]
+        for field_name in fields.keys():
+            if field_name not in xml_fields and not cls._inherits_field(field_name):
+                del fields[field_name]
+        cls._fields = fields.values()
+        cls._batched = [position for position, field in enumerate(cls._fields)
+                        if _reads_text(field) and not field.variables]
+        for position, field in enumerate(cls._fields):
+            setattr(cls, field._name, cls._get_xpath(position, field))
         if attrs.has_key("finders"):
             setattr(cls, "objects", ModelManager(cls, attrs["finders"]))
         else:
@@ -190,15 +493,33 @@ class ModelBase(type):
         if attrs.has_key("headers"):
             setattr(cls.objects, "headers", attrs["headers"])
     
-    def _get_xpath(cls, field_name, field_impl):
-        return property(fget=lambda cls: cls._parse_field(field_impl), fset=lambda cls, value : cls._set_value(field_impl, value))
+    def _inherits_field(cls, field_name):
+        """Returns whether the nearest definition of field_name, in the class or its bases, is a field, rather than
+        a method or other attribute that replaces an inherited field."""
+        for klass in cls.__mro__:
+            if field_name in klass.__dict__:
+                return klass is not cls and field_name in [field._name for field in klass.__dict__.get('_fields', [])]
+        return False
+
+    def _get_xpath(cls, position, field_impl):
+        return property(fget=lambda cls: cls._parse_field(position), fset=lambda cls, value : cls._set_value(position, value))
 
 XmlModelManager = ModelManager
 XmlModelQuery = ModelQuery
 
+_unparsed = object()
+
+class _Deferred(object):
+    """Stands in for the xml of models that keep no document, either because they were built by a query with only()
+    or defer(), or because they released it once every field was read."""
+    def __reduce__(self):
+        return '_deferred'
+
+_deferred = _Deferred()
 
 class Model:
     __metaclass__ = ModelBase
+    __slots__ = ('_xml', '_dom', '_values', '_unread', '_dirty')
     __doc__="""A model can be constructed with either an xml string, or an appropriate document supplied by
     the xpath_twister.domify() method.
     
@@ -210,11 +531,31 @@ class Model:
         nicknames = xml_models.CollectionField(CharField, xpath="/Person/Nicknames/Name")
         addresses = xml_models.CollectionField(Address, xpath="/Person/Addresses/Address")
         date_of_birth = xml_models.DateField(xpath="/Person/@DateOfBirth", date_format="%d-%m-%Y")
+
+    Models are slotted, so other attributes cannot be set on an instance unless the class declares them in
+    __slots__, e.g. __slots__ = ('__dict__',).
+
+    Each field is parsed the first time it is read, and the value kept on the instance until it is set, invalidated,
+    or the document is replaced.  Models that are read once, e.g. records streamed from a large response, can set
+    cache_fields = False to parse fields on every read instead; values that are set are still kept.
+
+    Fields that are set are written into the document by to_xml() or save(), which change only the nodes of those
+    fields, so they must be single valued fields with a plain path of named child steps, e.g. /Person/Address/@City.
+
+    Models kept for a long time can release their parsed document with detach(), keeping the xml so that fields that
+    are not cached can still be read, or set release_document to release it as soon as every field is cached: 'dom'
+    drops the DOM and keeps the xml, as detach() does, and 'all' drops both, after which invalidated fields can no
+    longer be read, and to_xml() and save() raise DeferredFieldError.  Collections of models built from the pure
+    python parser share its tree, and keep it alive.
     """
+    cache_fields = True
+    release_document = None
+
     def __init__(self, xml=None, dom=None):
         self._xml = xml
         self._dom = dom
-        self._cache = {}
+        self._set_values([_unparsed] * len(self._fields))
+        self._dirty = None
         self.validate_on_load()
 
     """Override on your model to perform validation when the XML data is first passed in. This is to ensure the xml returned
@@ -225,6 +566,9 @@ class Model:
 
     def _get_xml(self):
         if self._dom is None:
+            if self._xml is _deferred:
+                raise DeferredFieldError("%s has no document to read fields from, as it was built by a query with only() "
+                                         "or defer(), or has released it" % type(self).__name__)
             try :
                 self._dom = xpath.domify(self._xml or '<x/>')
             except Exception, e:
@@ -233,16 +577,273 @@ class Model:
                 raise e
         return self._dom
         
-    def _set_value(self, field, value):
-        self._cache[field] = value
+    def _set_values(self, values):
+        self._values = values
+        self._unread = values.count(_unparsed)
+
+    def _set_value(self, position, value):
+        if self._values[position] is _unparsed:
+            self._unread -= 1
+        self._values[position] = value
+        if self._dirty is None:
+            self._dirty = set()
+        self._dirty.add(position)
         
-    def _parse_field(self, field):
-        if not self._cache.has_key(field):
+    def _parse_field(self, position):
+        value = self._values[position]
+        if value is _unparsed:
             namespace = None
             if hasattr(self, 'namespace'):
                 namespace = self.namespace
-            self._cache[field] = field.parse(self._get_xml(), namespace)
-        return self._cache[field]
+            value = self._fields[position].parse(self._get_xml(), namespace)
+            if self.cache_fields:
+                self._values[position] = value
+                self._unread -= 1
+                if self.release_document and not self._unread:
+                    self._release()
+        return value
+
+    def _release(self):
+        if self.release_document == 'all' and not self._dirty:
+            self._xml = _deferred
+            self._dom = None
+        else:
+            self.detach()
+
+    def detach(self):
+        """Releases the parsed document, keeping the xml, serialized from the document if the model was built from
+        one, so fields that are not cached are parsed from it again when they are next read."""
+        if self._dom is not None:
+            if self._xml is None:
+                self._xml = xpath.tostring(self._dom)
+            self._dom = None
+
+    def _parse_all(self):
+        """Returns the values of all fields, reading those that hold a single value and have not been read yet with one
+        batch of xpath expressions."""
+        values = list(self._values)
+        pending = [position for position in self._batched if values[position] is _unparsed]
+        if pending:
+            namespace = None
+            if hasattr(self, 'namespace'):
+                namespace = self.namespace
+            found = xpath.find_unique_batch(self._get_xml(), [self._fields[position].xpath for position in pending], namespace)
+            for position, value in zip(pending, found):
+                field = self._fields[position]
+                if value is None:
+                    value = field._default
+                values[position] = field.to_python(value)
+                if self.cache_fields:
+                    self._values[position] = values[position]
+                    self._unread -= 1
+        for position, value in enumerate(values):
+            if value is _unparsed:
+                values[position] = self._parse_field(position)
+        if self.release_document and self.cache_fields and not self._unread:
+            self._release()
+        return values
+
+    def to_dict(self):
+        """Returns a dict mapping the name of each field to its value.  Models held by Collection and OneToOne fields
+        are converted with to_dict() too, and collections are returned as lists."""
+        result = {}
+        for field, value in zip(self._fields, self._parse_all()):
+            if isinstance(value, Model):
+                value = value.to_dict()
+            elif isinstance(field, Collection) and value is not None:
+                value = [item.to_dict() if isinstance(item, Model) else item for item in value]
+            result[field._name] = value
+        return result
+
+    def invalidate(self, *field_names):
+        """Discards the values of the named fields, or of all fields if none are named, including any that were set, so
+        they are parsed from the document again when next read."""
+        if not field_names:
+            self._set_values([_unparsed] * len(self._fields))
+            self._dirty = None
+        for field_name in field_names:
+            position = self._fields.index(self._field(field_name))
+            if self._values[position] is not _unparsed:
+                self._unread += 1
+            self._values[position] = _unparsed
+            if self._dirty:
+                self._dirty.discard(position)
+
+    def to_xml(self):
+        """Returns the document as a UTF-8 encoded xml string, with the values of the fields set since it was parsed,
+        or last saved, written into it.  Only the nodes of those fields are changed, and the document is serialized
+        once and kept until another field is set.  Every field set is checked before any is written, so if one of them
+        cannot be written the document is left unchanged.  Models built by a query with only() or defer(), or that
+        have released their document with release_document = 'all', keep no document, so raise DeferredFieldError."""
+        if self._xml is _deferred:
+            raise DeferredFieldError("%s has no document to write, as it was built by a query with only() or defer(), "
+                                     "or has released it with release_document = 'all'" % type(self).__name__)
+        if self._dirty:
+            namespace = None
+            if hasattr(self, 'namespace'):
+                namespace = self.namespace
+            dom = self._get_xml()
+            updates = []
+            for position in sorted(self._dirty):
+                field = self._fields[position]
+                if not hasattr(field, 'to_python') or field.variables:
+                    raise ValueError("%s cannot be written to the document" % field._name)
+                xpath.check_value(dom, field.xpath, namespace)
+                updates.append((field.xpath, field.to_xml(self._values[position])))
+            for expression, value in updates:
+                xpath.set_value(dom, expression, value, namespace)
+            self._dirty = None
+            self._xml = None
+        if self._xml is None or isinstance(self._xml, unicode):
+            self._xml = xpath.tostring(self._get_xml())
+        return self._xml
+
+    def save(self, url, headers=None):
+        """PUTs the document returned by to_xml() to url, returning the rest_client Response."""
+        if headers is None:
+            headers = self.objects.headers
+        return rest_client.Client("").PUT(url, self.to_xml(), headers=headers)
+
+    def __getstate__(self):
+        """Pickles the xml and the values of the fields that have been read or set, but not the DOM."""
+        xml = self._xml
+        if xml is None and self._dom is not None:
+            xml = xpath.tostring(self._dom)
+        values = dict((field._name, value) for field, value in zip(self._fields, self._values) if value is not _unparsed)
+        dirty = [self._fields[position]._name for position in self._dirty or ()]
+        return xml, values, dirty, getattr(self, '__dict__', None)
+
+    def __setstate__(self, state):
+        xml, values, dirty, attrs = state
+        self._xml = xml
+        self._dom = None
+        self._set_values([values.get(field._name, _unparsed) for field in self._fields])
+        self._dirty = None
+        if dirty:
+            self._dirty = set(self._fields.index(self._field(name)) for name in dirty)
+        if attrs:
+            self.__dict__.update(attrs)
+
+    def replace_document(self, xml=None, dom=None):
+        """Replaces the document the model reads its fields from, discarding all field values."""
+        self._xml = xml
+        self._dom = dom
+        self.invalidate()
+
+    def field_value(self, field_name, **variables):
+        """Parses the named field with the variables in its xpath bound to the values supplied.  The xpath is
+        only compiled once however many different values it is read with, and the result is not cached."""
+        field = copy.copy(self._field(field_name))
+        field.variables = dict(field.variables, **variables)
+        namespace = None
+        if hasattr(self, 'namespace'):
+            namespace = self.namespace
+        return field.parse(self._get_xml(), namespace)
+
+    @classmethod
+    def _field(cls, field_name):
+        for field in cls._fields:
+            if field._name == field_name:
+                return field
+        raise AttributeError(field_name)
+
+    @classmethod
+    def from_file(cls, source):
+        """Builds a model from source, a file object or file name, which is parsed as it is read rather than read
+        into a string first.  The model keeps no xml, so to_xml() serializes the document when first called."""
+        return cls(dom=xpath.domify_file(source))
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Builds a model from a document held in buffer, e.g. an mmap of a file, a bytearray or a memoryview, which
+        is parsed without copying it into a string first.  The buffer can be closed once the model is built."""
+        return cls(dom=xpath.domify_buffer(buffer))
+
+    @classmethod
+    def stream(cls, field_name, source):
+        """Yields the values of the named collection field one at a time, parsed straight from source, which may be a
+        file object, a file name or a rest_client Response, without holding the whole document in memory.  See
+        Collection.stream()."""
+        field = cls._field(field_name)
+        if not isinstance(field, Collection):
+            raise ValueError("%s is not a collection" % field_name)
+        if isinstance(source, rest_client.Response):
+            source = source.content
+        namespace = None
+        if hasattr(cls, 'namespace'):
+            namespace = cls.namespace
+        return field.stream(source, namespace)
+
+    @classmethod
+    def _documents(cls, stream):
+        return xpath.domify_records(stream)
+
+    @classmethod
+    def _from_document(cls, document):
+        return cls(dom=document)
+
+    @classmethod
+    def _from_values(cls, values):
+        model = cls.__new__(cls)
+        model._xml = _deferred
+        model._dom = None
+        model._set_values([values.get(field._name, _unparsed) for field in cls._fields])
+        model._dirty = None
+        model.validate_on_load()
+        return model
+
+    @classmethod
+    def _extract(cls, fragment, fields):
+        """Returns the values of the fields read from an xml string or document, without building a model."""
+        dom = xpath.domify(fragment)
+        namespace = None
+        if hasattr(cls, 'namespace'):
+            namespace = cls.namespace
+        return [field.parse(dom, namespace) for field in fields]
+
+    @classmethod
+    def parse_many(cls, documents, workers=None, max_pending=None):
+        """Builds a model from each xml string in documents, parsing the documents and extracting field values
+        in a pool of worker processes.  Models are yielded in input order, with the value of every field that does
+        not hold other models already cached.  validate_on_load is run in the worker."""
+        submitted = deque()
+        def submit():
+            for document in documents:
+                submitted.append(document)
+                yield document
+        for values in parallel.imap(_parse_in_worker, submit(), _init_parse_worker, (cls,), workers, max_pending):
+            model = cls.__new__(cls)
+            model._xml = submitted.popleft()
+            model._dom = None
+            model._set_values([values.get(field._name, _unparsed) for field in cls._fields])
+            model._dirty = None
+            yield model
+
+
+def dump_jsonl(models, stream):
+    """Writes each of the models to stream as a line of JSON, from its to_dict().  Dates are written in ISO format."""
+    for model in models:
+        stream.write(json.dumps(model.to_dict(), default=_json_default, separators=(',', ':')))
+        stream.write('\n')
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % value)
+
+def _holds_models(field):
+    return isinstance(field, OneToOneField) or (isinstance(field, Collection) and not BaseField in field.field_type.__bases__)
+
+_worker_model = None
+
+def _init_parse_worker(model):
+    global _worker_model
+    _worker_model = model
+
+def _parse_in_worker(xml):
+    model = _worker_model(xml)
+    return dict((field._name, model._parse_field(position)) for position, field in enumerate(_worker_model._fields)
+                if not _holds_models(field))
 
 
 
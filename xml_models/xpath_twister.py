@@ -26,8 +26,12 @@ authors and should not be interpreted as representing official policies, either
 or implied, of the FreeBSD Project.
 """
 
-import unittest
+import unittest, copy, re
 from xml.dom import minidom
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 import xpath
 
 class MultipleNodesReturnedException(Exception):
@@ -40,24 +44,148 @@ try:
 except:
     pass
 
-def find_unique(xml, expression, namespace=None):
-    if lxml_available:
-        return _lxml_xpath(xml, expression, namespace)
-    else:
-        return _pydom_xpath(xml, expression, namespace)
+def find_unique(xml, expression, namespace=None, **variables):
+    return prepare(expression, namespace).find_unique(xml, **variables)
+    
+def find_all(xml, expression, namespace=None, **variables):
+    return prepare(expression, namespace).find_all(xml, **variables)
+
+def find_fragments(xml, expression, namespace=None, **variables):
+    return prepare(expression, namespace).find_fragments(xml, **variables)
+
+def find_values(xml, expression, namespace=None, **variables):
+    return prepare(expression, namespace).find_values(xml, **variables)
+
+class PreparedXPath(object):
+    """An expression compiled once for whichever backend is in use, and evaluated many times.  The expression
+    may refer to variables, e.g. /Orders/Order[@id=$oid], which are bound by keyword arguments when it is
+    evaluated, so lookups by value never need to format a new expression and parse it again."""
+    def __init__(self, expression, namespace=None):
+        self.expression = expression
+        self.namespace = namespace
+        self._steps = None
+        if lxml_available:
+            self._find = _lxml_compile(expression, namespace)
+        else:
+            self._find = xpath.XPath.get(expression)
+            match = _simple_path.match(expression)
+            if match is not None:
+                self._steps = match.group(1).split('/')[1:]
+                self._attribute = match.group(2)
+                self._paths = {}
+
+    def _direct(self, xml, variables):
+        """True if the expression is a plain path of named child steps, optionally ending with an attribute, and xml
+        is an ElementTree document, so the expression can be evaluated by ElementTree itself."""
+        return self._steps is not None and not variables and isinstance(xml, xpath.expr.EtreeDocument)
+
+    def _etree_findall(self, xml):
+        namespace = self.namespace or xml.namespaces.get('')
+        try:
+            root_tag, path = self._paths[namespace]
+        except KeyError:
+            tags = self._steps
+            if namespace:
+                tags = ['{%s}%s' % (namespace, tag) for tag in tags]
+            root_tag, path = self._paths[namespace] = (tags[0], '/'.join(tags[1:]))
+        root = xml.documentElement.element
+        if root.tag != root_tag:
+            return []
+        if not path:
+            return [root]
+        return root.findall(path)
+
+    def find_unique(self, xml, **variables):
+        if lxml_available:
+            return _lxml_value(self._find(xml, **variables))
+        elif self._direct(xml, variables):
+            elements = self._etree_findall(xml)
+            if self._attribute:
+                elements = [element for element in elements if self._attribute in element.attrib]
+            if len(elements) > 1:
+                raise MultipleNodesReturnedException
+            if not elements:
+                return None
+            if self._attribute:
+                return xpath.expr.etree_text(elements[0].get(self._attribute))
+            return xpath.expr.etree_text(elements[0].text)
+        else:
+            return _pydom_value(self._find.find(xml, default_namespace=self.namespace, variables=variables))
+
+    def find_all(self, xml, **variables):
+        if lxml_available:
+            return [etree.tostring(match) for match in self._find(xml, **variables)]
+        else:
+            nodelist = self._find.find(xml, default_namespace=self.namespace, variables=variables)
+            return [fragment.toxml() for fragment in nodelist]
+
+    def find_values(self, xml, **variables):
+        """Returns the text of each element, or the value of each attribute, matched by the expression, without
+        serializing the matches.  Elements with no text give None."""
+        if lxml_available:
+            return [match.text if isinstance(match, etree._Element) else match for match in self._find(xml, **variables)]
+        elif self._direct(xml, variables):
+            elements = self._etree_findall(xml)
+            if self._attribute:
+                return [xpath.expr.etree_text(element.get(self._attribute)) for element in elements if self._attribute in element.attrib]
+            return [xpath.expr.etree_text(element.text) for element in elements]
+        else:
+            nodelist = self._find.find(xml, default_namespace=self.namespace, variables=variables)
+            return [_pydom_text(node) for node in nodelist]
+
+    def find_fragments(self, xml, **variables):
+        """Like find_all, but where the document was parsed by domify() with the pure python backend, matched
+        elements are returned as documents sharing the parsed tree, which domify() passes straight through, rather
+        than as strings to be parsed again."""
+        if lxml_available:
+            return self.find_all(xml, **variables)
+        elif self._direct(xml, variables) and not self._attribute and not xml.scopes:
+            return [xpath.expr.EtreeDocument(element, xml.namespaces) for element in self._etree_findall(xml)]
+        else:
+            nodelist = self._find.find(xml, default_namespace=self.namespace, variables=variables)
+            return [_pydom_fragment(node) for node in nodelist]
+
+_simple_path = re.compile(r'^((?:/[A-Za-z_][\w.-]*)+)(?:/@([A-Za-z_][\w.-]*))?$')
+
+_max_prepared = 100
+_prepared = {}
+
+def prepare(expression, namespace=None):
+    """Returns a PreparedXPath for the expression, reusing a previously prepared one where possible."""
+    if isinstance(expression, PreparedXPath):
+        return expression
+    key = (expression, namespace)
+    try:
+        return _prepared[key]
+    except KeyError:
+        if len(_prepared) > _max_prepared:
+            _prepared.clear()
+        prepared = _prepared[key] = PreparedXPath(expression, namespace)
+        return prepared
     
-def find_all(xml, expression, namespace=None):
+def find_unique_batch(xml, expressions, namespace=None):
+    """Returns the unique value found by each expression, in order.  With the pure python backend
+    the expressions are evaluated together, sharing any common location path prefix."""
     if lxml_available:
-        return _lxml_xpath_all(xml, expression, namespace)
+        return [prepare(expression, namespace).find_unique(xml) for expression in expressions]
     else:
-        return _pydom_xpath_all(xml, expression, namespace)
-    
+        prepared = [prepare(expression, namespace) for expression in expressions]
+        direct = [p._direct(xml, None) for p in prepared]
+        if not all(direct):
+            batched = [p.expression for p, d in zip(prepared, direct) if not d]
+            found = iter(_pydom_xpath_batch(xml, batched, namespace))
+        return [p.find_unique(xml) if d else found.next() for p, d in zip(prepared, direct)]
+
+def _lxml_compile(expression, namespace):
+    if namespace:
+        return etree.XPath(get_xpath(expression, namespace), namespaces={'x': namespace})
+    else:
+        return etree.XPath(get_xpath(expression, namespace))
+
 def _lxml_xpath(xml_doc, expression, namespace):
-        if namespace:
-            find = etree.XPath(get_xpath(expression, namespace), namespaces={'x': namespace})
-        else:
-            find = etree.XPath(get_xpath(expression, namespace))
-        matches = find(xml_doc)
+        return _lxml_value(_lxml_compile(expression, namespace)(xml_doc))
+
+def _lxml_value(matches):
         if len(matches) == 1:
             matched = matches[0]
             if type(matched) == type(''):
@@ -74,34 +202,241 @@ def _lxml_xpath(xml_doc, expression, namespace):
         if len(matches) > 1:
             raise MultipleNodesReturnedException
     
-def _lxml_xpath_all(xml, expression, namespace):
-    if namespace:
-        find = etree.XPath(get_xpath(expression, namespace), namespaces={'x': namespace})
+def domify_records(stream):
+    """Parses a list document, e.g. <people><person/><person/></people>, in a single pass, yielding a document for
+    each child of the root with the same name as the first child.  Each record is detached from the list once it has
+    been parsed, so memory use stays flat unless the documents are kept."""
+    if lxml_available:
+        return _lxml_records(stream)
+    else:
+        return _pydom_records(stream)
+
+def _lxml_records(stream):
+    depth = 0
+    record_tag = None
+    for event, elem in etree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if record_tag is None:
+                record_tag = elem.tag
+            record = None
+            if elem.tag == record_tag:
+                record = copy.deepcopy(elem)
+            elem.getparent().remove(elem)
+            if record is not None:
+                yield record
+
+def _pydom_records(stream):
+    depth = 0
+    record_tag = None
+    for event, elem, namespaces in xpath.expr.iterparse_scoped(stream):
+        if event == 'start':
+            if depth == 0:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if record_tag is None:
+                record_tag = elem.tag
+            root.remove(elem)
+            if elem.tag == record_tag:
+                yield xpath.expr.EtreeDocument(elem, namespaces)
+
+def iter_documents(stream, expression, namespace=None):
+    """Parses a document from stream, a file object or file name, in a single pass, yielding a document for each
+    element selected by a plain path of named child steps, e.g. /Feed/Items/Item, as soon as it has been parsed.
+    Every element at the depth of the selected elements is detached from the tree once it has been parsed, so memory
+    use stays flat however large the document is, unless the documents are kept."""
+    match = _simple_path.match(expression)
+    if match is None or match.group(2):
+        raise ValueError("Can only stream elements selected by a path of named child steps, not %s" % expression)
+    tags = match.group(1).split('/')[1:]
+    if lxml_available:
+        return _lxml_stream(stream, tags, namespace)
     else:
-        find = etree.XPath(get_xpath(expression,namespace))
-    matches = find(xml)
-    return [etree.tostring(match) for match in matches]
+        return _pydom_stream(stream, tags, namespace)
+
+def _lxml_stream(stream, tags, namespace):
+    matched = []
+    for event, elem in etree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            matched.append(_step_matches(elem.tag, tags, matched, namespace or elem.nsmap.get(None)))
+            continue
+        if len(matched) == len(tags):
+            record = None
+            if matched[-1]:
+                record = copy.deepcopy(elem)
+            parent = elem.getparent()
+            if parent is not None:
+                parent.remove(elem)
+            if record is not None:
+                yield record
+        matched.pop()
+
+def _step_matches(tag, tags, matched, namespace):
+    # Each step is matched against the default namespace in scope at the element, as the documents yielded are.
+    depth = len(matched)
+    if depth >= len(tags) or (matched and not matched[-1]):
+        return False
+    if namespace:
+        return tag == '{%s}%s' % (namespace, tags[depth])
+    return tag == tags[depth]
+
+def _pydom_stream(stream, tags, namespace):
+    matched = []
+    elements = []
+    for event, elem, namespaces in xpath.expr.iterparse_scoped(stream):
+        if event == 'start':
+            matched.append(_step_matches(elem.tag, tags, matched, namespace or namespaces.get('')))
+            elements.append(elem)
+            continue
+        elements.pop()
+        if len(matched) == len(tags):
+            if elements:
+                elements[-1].remove(elem)
+            if matched[-1]:
+                yield xpath.expr.EtreeDocument(elem, namespaces)
+        matched.pop()
 
 def domify(xml):
+    if not isinstance(xml, basestring):
+        return xml
+    if isinstance(xml, unicode):
+        # the text is already decoded, so any encoding it declares no longer applies
+        xml = _xml_declaration.sub(u'', xml, 1)
     if lxml_available:
         return objectify.fromstring(xml)
     else:
-        return minidom.parseString(xml)
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        return xpath.parse(xml)
 
-def _pydom_xpath_all(xml, expression, namespace):
-    nodelist = xpath.find(expression, xml, default_namespace=namespace)
-    return [fragment.toxml() for fragment in nodelist]
+_xml_declaration = re.compile(ur'^\s*<\?xml\b[^>]*\?>')
+
+def domify_file(source):
+    """Parses a document from source, a file object or file name, reading it in chunks rather than into a string
+    first.  Returns the same kind of document as domify()."""
+    if lxml_available:
+        return objectify.parse(source).getroot()
+    else:
+        return xpath.expr.EtreeDocument.fromfile(source)
+
+def domify_buffer(buffer):
+    """Parses a document held in buffer, e.g. an mmap, a bytearray or a memoryview, reading it in chunks rather than
+    copying it into a string first.  Returns the same kind of document as domify()."""
+    return domify_file(_BufferReader(buffer))
+
+class _BufferReader(object):
+    """A read-only file object over a buffer, which is read from its start whatever its own position."""
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        if size is None or size < 0:
+            end = len(self._buffer)
+        else:
+            end = min(start + size, len(self._buffer))
+        self._position = end
+        chunk = self._buffer[start:end]
+        if hasattr(chunk, 'tobytes'):
+            return chunk.tobytes()
+        return str(chunk)
+
+def check_value(xml, expression, namespace=None):
+    """Raises the error set_value() would raise for the expression, without changing the document."""
+    root, tags, attribute, new_element = _value_path(xml, expression, namespace)
+    element = root
+    for tag in tags[1:]:
+        children = element.findall(tag)
+        if len(children) > 1:
+            raise MultipleNodesReturnedException
+        if not children:
+            break
+        element = children[0]
+
+def set_value(xml, expression, value, namespace=None):
+    """Sets the text of the element, or the value of the attribute, selected by a plain path of named child steps, e.g.
+    /Order/Customer/@id, in a document returned by domify() or domify_records().  Elements missing from the path are
+    added, and a value of None empties the element or removes the attribute.  The document is changed in place."""
+    root, tags, attribute, new_element = _value_path(xml, expression, namespace)
+    element = root
+    for tag in tags[1:]:
+        children = element.findall(tag)
+        if len(children) > 1:
+            raise MultipleNodesReturnedException
+        if children:
+            element = children[0]
+        else:
+            element = new_element(element, tag)
+    if attribute is None and lxml_available:
+        # objectify elements have a read only text property
+        etree._Element.text.__set__(element, value)
+    elif attribute is None:
+        element.text = value
+    elif value is None:
+        element.attrib.pop(attribute, None)
+    else:
+        element.set(attribute, value)
+    if not lxml_available:
+        xml.reset()
+
+def _value_path(xml, expression, namespace):
+    match = _simple_path.match(expression)
+    if match is None:
+        raise ValueError("Can only set values by a path of named child steps, not %s" % expression)
+    tags = match.group(1).split('/')[1:]
+    attribute = match.group(2)
+    if lxml_available:
+        root = xml
+        new_element = etree.SubElement
+    else:
+        root = xml.documentElement.element
+        namespace = namespace or xml.namespaces.get('')
+        new_element = ElementTree.SubElement
+    if namespace:
+        tags = ['{%s}%s' % (namespace, tag) for tag in tags]
+    if root.tag != tags[0]:
+        raise ValueError("%s does not match the root element of the document" % expression)
+    return root, tags, attribute, new_element
+
+def tostring(dom):
+    """Serializes a document returned by domify() or domify_records() as a str, which is UTF-8 encoded."""
+    if lxml_available:
+        return etree.tostring(dom)
+    else:
+        return dom.toxml().encode('utf-8')
+
+def _pydom_fragment(node):
+    if isinstance(node, xpath.expr.EtreeElement):
+        return node.ownerDocument.fragment(node)
+    return node.toxml()
 
 def _pydom_xpath(xml, expression, namespace):
     nodelist = xpath.find(expression, xml, default_namespace=namespace)
+    return _pydom_value(nodelist)
+
+def _pydom_xpath_batch(xml, expressions, namespace):
+    nodelists = xpath.findbatch(expressions, xml, default_namespace=namespace)
+    return [_pydom_value(nodelist) for nodelist in nodelists]
+
+def _pydom_value(nodelist):
     if len(nodelist) > 1:
         raise MultipleNodesReturnedException
     if len(nodelist) == 0:
         return None
-    if nodelist[0].nodeType == minidom.Node.DOCUMENT_NODE:
-        node = nodelist[0].firstChild.firstChild
+    return _pydom_text(nodelist[0])
+
+def _pydom_text(node):
+    if node.nodeType == minidom.Node.DOCUMENT_NODE:
+        node = node.firstChild.firstChild
     else:
-        node = nodelist[0].firstChild
+        node = node.firstChild
     if node == None:
         return None
     if node.nodeType == minidom.Node.TEXT_NODE:
@@ -141,7 +476,44 @@ class XPathTest(unittest.TestCase):
         val = _pydom_xpath(xml, "/foo/bar", None)
         #assert
         self.assertEquals(u"abcd\xe9", val)
+
+    def test_xpath_batch_returns_expected_value_for_each_expression(self):
+        #setup
+        xml = minidom.parseString('<foo><baz name="Arthur">dcba</baz><bar>abcd</bar></foo>')
+        #execute
+        vals = _pydom_xpath_batch(xml, ["/foo/bar", "/foo/baz/@name", "/foo/baz", "/foo/qux"], None)
+        #assert
+        self.assertEquals(["abcd", "Arthur", "dcba", None], vals)
     
+    def test_prepared_xpath_binds_variables_when_evaluated(self):
+        #setup
+        xml = domify('<orders><order id="1">first</order><order id="2">second</order></orders>')
+        find = prepare("/orders/order[@id=$oid]")
+        #execute
+        vals = [find.find_unique(xml, oid=oid) for oid in ("2", "1", "3")]
+        #assert
+        self.assertEquals(["second", "first", None], vals)
+        self.assertTrue(prepare("/orders/order[@id=$oid]") is find)
+
+    def test_set_value_changes_the_document_in_place(self):
+        #setup
+        xml = domify('<orders><order id="1">first</order></orders>')
+        #execute
+        set_value(xml, "/orders/order/@id", "2")
+        set_value(xml, "/orders/order/note", "new")
+        #assert
+        self.assertEquals("2", find_unique(xml, "/orders/order[note='new']/@id"))
+        self.assertEquals('<orders><order id="2">first<note>new</note></order></orders>', tostring(xml))
+
+    def test_find_all_binds_variables(self):
+        #setup
+        xml = domify('<orders><order id="1"/><order id="2"/></orders>')
+        #execute
+        vals = find_all(xml, "/orders/order[@id=$oid]", oid="2")
+        #assert
+        self.assertEquals(1, len(vals))
+        self.assertTrue('id="2"' in vals[0])
+
     def test_xpath_returns_expected_attribute_value(self):
         #setup
         xml = minidom.parseString('<foo><baz name="Arthur">dcba</baz><bar>abcd</bar></foo>')
@@ -27,6 +27,8 @@ or implied, of the FreeBSD Project.
 """
 
 import unittest
+import pickle
+import array, math, json, mmap, tempfile
 from xml_models import *
 from common_models import *
 from xml_models.xml_models_stub import stub
@@ -100,6 +102,34 @@ class XmlModelsTest(unittest.TestCase):
         response = field.parse(xml, None)
         self.assertEquals(123, response)
     
+    def test_simple_paths_read_text_attributes_and_default_namespace(self):
+        xml = xpath.domify('<root><kiddie name="Gonzo"><value>abc</value></kiddie><kiddie><value/><value/></kiddie></root>')
+        self.assertEquals('Gonzo', CharField(xpath='/root/kiddie/@name').parse(xml, None))
+        self.assertEquals('x', CharField(xpath='/other/kiddie', default='x').parse(xml, None))
+        self.assertRaises(xpath.MultipleNodesReturnedException, CharField(xpath='/root/kiddie').parse, xml, None)
+        self.assertEquals(['Gonzo', None, None], xpath.find_unique_batch(xml, ['/root/kiddie/@name', '/root/x', '/root/kiddie[2]/value[1]']))
+        xml = xpath.domify('<root xmlns="urn:a"><kiddie><value>abc</value></kiddie></root>')
+        self.assertEquals('abc', CharField(xpath='/root/kiddie/value').parse(xml, 'urn:a'))
+
+    def test_default_namespaces_declared_below_the_root_do_not_apply_to_the_whole_document(self):
+        xml = xpath.domify('<root><kiddie xmlns="urn:a"><value>abc</value></kiddie><value>def</value></root>')
+        self.assertEquals(u'def', CharField(xpath='/root/value').parse(xml, None))
+        self.assertTrue(isinstance(xpath.find_unique(xml, '/root/value'), unicode))
+        documents = list(xpath.iter_documents(StringIO('<root><kiddie xmlns="urn:a"><value>1</value></kiddie>'
+                                                       '<kiddie><value>2</value></kiddie></root>'), '/root/kiddie'))
+        self.assertEquals(2, len(documents))
+        if not xpath.lxml_available:
+            self.assertEquals([1, 2], [IntField(xpath='/kiddie/value').parse(document, None) for document in documents])
+
+    def test_records_read_the_default_namespace_in_scope_at_the_record(self):
+        documents = list(Listing._documents(StringIO('<Listings><Listing id="7"><Agent xmlns="urn:b">Zoe</Agent></Listing>'
+                                                     '<Listing id="8"/></Listings>')))
+        self.assertEquals([7, 8], [Listing._from_document(document).listing_id for document in documents])
+
+    def test_unicode_documents_ignore_their_declared_encoding(self):
+        xml = xpath.domify(u'<?xml version="1.0" encoding="latin-1"?><root><value>\xe9</value></root>')
+        self.assertEquals(u'\xe9', CharField(xpath='/root/value').parse(xml, None))
+
     def test_date_field_returns_xpathed_value_for_the_node_passed_in(self):
         xml_string = '<root><kiddie><value>2008-06-21T10:36:12</value></kiddie></root>'
         xml = xpath.domify(xml_string)
@@ -116,6 +146,30 @@ class XmlModelsTest(unittest.TestCase):
         date = datetime.datetime(2008,06,21,10,36,12)
         self.assertEquals(date, response)
         
+    def test_date_field_parses_fractional_seconds(self):
+        field = DateField(xpath='/root/kiddie/value')
+        self.assertEquals(datetime.datetime(2008,06,21,10,36,12,123000), field.to_datetime('2008-06-21T10:36:12.123'))
+        self.assertEquals(datetime.datetime(2008,06,21,10,36,12,500000), field.to_datetime('2008-06-21T10:36:12,5Z'))
+        self.assertEquals(datetime.datetime(2008,06,21,10,36,12,123456), field.to_datetime('2008-06-21T10:36:12.1234567-06:00'))
+
+    def test_date_field_keeps_utc_offset_when_tz_aware(self):
+        field = DateField(xpath='/root/kiddie/value', tz_aware=True)
+        response = field.to_datetime('2008-06-21T10:36:12.250-06:30')
+        self.assertEquals(datetime.timedelta(hours=-6, minutes=-30), response.utcoffset())
+        self.assertEquals(datetime.datetime(2008,06,21,17,6,12,250000), response.replace(tzinfo=None) - response.utcoffset())
+        self.assertEquals(datetime.timedelta(0), field.to_datetime('2008-06-21T10:36:12').utcoffset())
+        self.assertEquals(datetime.timedelta(0), field.to_datetime('2008-06-21T10:36:12Z').utcoffset())
+
+    def test_date_field_uses_supplied_date_format(self):
+        field = DateField(xpath='/root/kiddie/value', date_format="%d-%m-%Y %H:%M:%S")
+        self.assertEquals(datetime.datetime(2008,06,21,10,36,12,123000), field.to_datetime('21-06-2008 10:36:12.123'))
+        field = DateField(xpath='/root/kiddie/value', date_format="%d-%m-%Y %H:%M:%S", tz_aware=True)
+        self.assertEquals(datetime.timedelta(hours=2), field.to_datetime('21-06-2008 10:36:12+02:00').utcoffset())
+
+    def test_date_field_rejects_values_not_in_date_format(self):
+        field = DateField(xpath='/root/kiddie/value')
+        self.assertRaises(ValueError, field.to_datetime, '2008-06-21')
+
     def test_date_field_returns_none_when_xpathed_value_for_the_node_is_none(self):
         xml_string = '<root><kiddie><value></value></kiddie></root>'
         xml = xpath.domify(xml_string)
@@ -207,6 +261,346 @@ class XmlModelsTest(unittest.TestCase):
         self.assertTrue('Fozzie' in my_model.muppet_names)
         self.assertTrue('Gonzo' in my_model.muppet_names)
 
+    def test_models_are_slotted(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value></kiddie></root>')
+        self.assertFalse(hasattr(my_model, '__dict__'))
+        self.assertRaises(AttributeError, setattr, my_model, 'colour', 'green')
+
+    def test_subclasses_inherit_and_override_fields(self):
+        my_model = ExtendedSimple('<root><field1>one</field1><field2>two</field2></root>')
+        self.assertEquals('one', my_model.field1)
+        self.assertEquals('two', my_model.field2)
+        self.assertEquals('one', my_model.loud)
+        my_model.colour = 'green'
+        self.assertEquals(3, len(ExtendedSimple._fields))
+
+    def test_subclasses_can_replace_inherited_fields_with_other_attributes(self):
+        class Quiet(LoudSimple):
+            def loud(self):
+                return self.field1.lower()
+        class Quieter(Quiet):
+            field2 = CharField(xpath='/root/field2')
+        for model in [Quiet, Quieter]:
+            my_model = model('<root><field1>ONE</field1><loud>TWO</loud><field2>three</field2></root>')
+            self.assertEquals('one', my_model.loud())
+            self.assertFalse('loud' in my_model.to_dict())
+        self.assertEquals(['field1'], [field._name for field in Quiet._fields])
+        self.assertEquals('three', Quieter('<root><field2>three</field2></root>').field2)
+
+    def test_field_values_are_cached_per_instance(self):
+        gonzo = MyModel('<root><kiddie><value>Gonzo</value></kiddie></root>')
+        fozzie = MyModel('<root><kiddie><value>Fozzie</value></kiddie></root>')
+        self.assertEquals('Gonzo', gonzo.muppet_name)
+        self.assertEquals('Fozzie', fozzie.muppet_name)
+        gonzo._dom = None
+        gonzo._xml = None
+        self.assertEquals('Gonzo', gonzo.muppet_name)
+
+    def test_invalidated_fields_are_parsed_again(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value><type>bear</type></kiddie></root>')
+        my_model.muppet_name = 'Fozzie'
+        my_model.muppet_type = 'frog'
+        my_model.invalidate('muppet_name')
+        self.assertEquals('Gonzo', my_model.muppet_name)
+        self.assertEquals('frog', my_model.muppet_type)
+        my_model.invalidate()
+        self.assertEquals('bear', my_model.muppet_type)
+
+    def test_replacing_the_document_discards_field_values(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value></kiddie></root>')
+        self.assertEquals('Gonzo', my_model.muppet_name)
+        my_model.replace_document('<root><kiddie><value>Fozzie</value></kiddie></root>')
+        self.assertEquals('Fozzie', my_model.muppet_name)
+
+    def test_to_xml_writes_only_the_fields_that_were_set(self):
+        listing = Listing('<Listing id="7" price="10.5"><Agent>Zoe</Agent><Notes>keep</Notes></Listing>')
+        self.assertEquals('<Listing id="7" price="10.5"><Agent>Zoe</Agent><Notes>keep</Notes></Listing>', listing.to_xml())
+        listing.price = 12.25
+        listing.agent = 'Kermit'
+        listing.listed = datetime.datetime(2014, 1, 2, 3, 4, 5, tzinfo=FixedOffset(60))
+        restored = Listing(listing.to_xml())
+        self.assertEquals(7, restored.listing_id)
+        self.assertEquals(12.25, restored.price)
+        self.assertEquals('Kermit', restored.agent)
+        self.assertEquals(datetime.datetime(2014, 1, 2, 3, 4, 5, tzinfo=FixedOffset(60)), restored.listed)
+        self.assertTrue('<Notes>keep</Notes>' in listing.to_xml())
+
+    def test_to_xml_adds_missing_elements_and_removes_attributes_set_to_none(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value></kiddie></root>')
+        my_model.muppet_type = 'bear'
+        self.assertEquals('<root><kiddie><value>Gonzo</value><type>bear</type></kiddie></root>', my_model.to_xml())
+        listing = Listing('<Listing id="7"/>')
+        listing.listing_id = None
+        self.assertEquals(None, Listing(listing.to_xml()).listing_id)
+
+    def test_collections_cannot_be_written_to_the_document(self):
+        my_model = MyModel('<root><kiddie><age>3</age></kiddie></root>')
+        my_model.muppet_ages = [4]
+        self.assertRaises(ValueError, my_model.to_xml)
+
+    def test_to_xml_fails_without_writing_any_field_if_one_cannot_be_written(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value><age>3</age></kiddie></root>')
+        my_model.muppet_name = 'Fozzie'
+        my_model.muppet_ages = [4]
+        self.assertRaises(ValueError, my_model.to_xml)
+        self.assertEquals('Gonzo', MyModel(xpath.tostring(my_model._dom)).muppet_name)
+
+    def test_to_xml_keeps_the_default_namespace(self):
+        class Namespaced(Model):
+            namespace = 'urn:x'
+            listing_id = IntField(xpath='/Listing/@id')
+            agent = CharField(xpath='/Listing/Agent')
+        class Unqualified(Model):
+            listing_id = IntField(xpath='/Listing/@id')
+            agent = CharField(xpath='/Listing/Agent')
+        models = [Namespaced]
+        if not xpath.lxml_available:
+            # only the pure python backend reads unprefixed names in the document's default namespace
+            models.append(Unqualified)
+        for model in models:
+            listing = model('<Listing xmlns="urn:x" id="1"><Agent>Zoe</Agent></Listing>')
+            listing.listing_id = 5
+            restored = model(listing.to_xml())
+            self.assertEquals((5, 'Zoe'), (restored.listing_id, restored.agent))
+
+    @patch.object(rest_client.Client, "PUT")
+    def test_save_puts_the_patched_document(self, mock_put):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value></kiddie></root>')
+        my_model.muppet_name = 'Fozzie'
+        my_model.save('http://foo.com/muppets/Gonzo')
+        mock_put.assert_called_with('http://foo.com/muppets/Gonzo', '<root><kiddie><value>Fozzie</value></kiddie></root>', headers={})
+
+    @patch.object(rest_client.Client, "PUT")
+    def test_to_xml_and_save_encode_non_ascii_values(self, mock_put):
+        listing = Listing(u'<Listing id="7"><Agent>Zo\xeb</Agent></Listing>')
+        self.assertEquals(u'Zo\xeb', Listing(listing.to_xml()).agent)
+        listing.agent = u'Ren\xe9e'
+        xml = listing.to_xml()
+        self.assertTrue(isinstance(xml, str))
+        self.assertEquals(u'Ren\xe9e', Listing(xml).agent)
+        listing.save('http://foo.com/listings/7')
+        sent = mock_put.call_args[0][1]
+        self.assertTrue(isinstance(sent, str))
+        self.assertEquals(u'Ren\xe9e', Listing(sent).agent)
+
+    def test_models_release_the_dom_once_every_field_is_cached(self):
+        my_model = ReleasingSimple('<root><field1>one</field1><field2>2</field2></root>')
+        self.assertEquals('one', my_model.field1)
+        self.assertNotEquals(None, my_model._dom)
+        self.assertEquals(2, my_model.field2)
+        self.assertEquals(None, my_model._dom)
+        my_model.invalidate('field1')
+        self.assertEquals('one', my_model.field1)
+        self.assertEquals(None, my_model._dom)
+
+    def test_models_can_release_the_xml_as_well(self):
+        my_model = ForgetfulSimple('<root><field1>one</field1><field2>2</field2></root>')
+        self.assertEquals({'field1': 'one', 'field2': 2}, my_model.to_dict())
+        self.assertEquals(None, my_model._dom)
+        self.assertEquals('one', my_model.field1)
+        my_model.invalidate('field1')
+        self.assertRaises(DeferredFieldError, getattr, my_model, 'field1')
+
+    def test_models_that_released_the_xml_refuse_to_write_it(self):
+        my_model = ForgetfulSimple('<root><field1>one</field1><field2>2</field2></root>')
+        my_model.field1 = 'two'
+        self.assertEquals(2, my_model.field2)
+        self.assertEquals('<root><field1>two</field1><field2>2</field2></root>', my_model.to_xml())
+        my_model.invalidate('field1')
+        self.assertEquals('two', my_model.field1)
+        self.assertEquals(None, my_model._dom)
+        self.assertRaises(DeferredFieldError, my_model.to_xml)
+
+    def test_detached_models_parse_uncached_fields_again(self):
+        document = [document for document in Simple._documents(StringIO('<list><root><field1>one</field1></root></list>'))][0]
+        my_model = Simple._from_document(document)
+        my_model.detach()
+        self.assertEquals(None, my_model._dom)
+        self.assertEquals('one', my_model.field1)
+
+    def test_uncached_models_parse_fields_on_every_read(self):
+        my_model = UncachedSimple('<root><field1>one</field1></root>')
+        self.assertEquals('one', my_model.field1)
+        my_model._dom = xpath.domify('<root><field1>two</field1></root>')
+        self.assertEquals('two', my_model.field1)
+        my_model.field1 = 'three'
+        self.assertEquals('three', my_model.field1)
+
+    def test_collections_build_models_only_when_used(self):
+        my_model = MyModel('<root><kiddie><address><number>3</number></address><address><number>4</number></address>'
+                           '<address><number>5</number></address><address><number>6</number></address></kiddie></root>')
+        addresses = my_model.muppet_addresses
+        built = lambda: len([item for item in list.__iter__(addresses) if isinstance(item, Address)])
+        self.assertEquals(4, len(addresses))
+        self.assertEquals(0, built())
+        self.assertEquals(6, addresses[-1].number)
+        self.assertEquals([4, 5], [address.number for address in addresses[1:3]])
+        self.assertEquals(3, built())
+        self.assertEquals([3, 4, 5, 6], [address.number for address in addresses])
+        self.assertEquals(4, built())
+
+    def test_collections_are_lists(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value><age>3</age><age>4</age>'
+                           '<address><number>5</number></address><address><number>6</number></address></kiddie></root>')
+        self.assertTrue(isinstance(my_model.muppet_ages, list))
+        self.assertEquals('[3, 4]', json.dumps(my_model.muppet_ages))
+        self.assertEquals([3, 4, 5], my_model.muppet_ages + [5])
+        addresses = my_model.muppet_addresses
+        self.assertTrue(isinstance(addresses, list))
+        self.assertEquals([1, 6], [1] + [address.number for address in addresses[1:]])
+        self.assertEquals(3, len(addresses + [None]))
+        self.assertEquals(3, len([None] + addresses))
+        self.assertTrue(all(isinstance(address, Address) for address in [None] + addresses if address))
+        self.assertTrue(addresses < addresses + [None])
+        self.assertEquals(addresses[1], addresses.pop())
+        self.assertEquals(1, len(addresses))
+
+    def test_collections_can_be_modified_and_pickled(self):
+        my_model = MyModel('<root><kiddie><age>3</age><age>4</age></kiddie></root>')
+        ages = my_model.muppet_ages
+        ages.insert(0, 1)
+        del ages[1]
+        ages.extend([7, 8])
+        ages[0:2] = [2]
+        self.assertEquals([2, 7, 8], ages)
+        self.assertEquals([2, 7, 8], pickle.loads(pickle.dumps(ages)))
+
+    def test_model_can_be_built_from_a_file_or_buffer(self):
+        my_model = MyModel.from_file(StringIO('<root><kiddie><value>Gonzo</value><age>3</age></kiddie></root>'))
+        self.assertEquals('Gonzo', my_model.muppet_name)
+        self.assertEquals([3], my_model.muppet_ages)
+        self.assertEquals('Rowlf', MyModel.from_buffer(memoryview('<root><kiddie><value>Rowlf</value></kiddie></root>')).muppet_name)
+        with tempfile.NamedTemporaryFile() as stream:
+            stream.write('<root><kiddie><value>Kermit</value></kiddie></root>')
+            stream.flush()
+            self.assertEquals('Kermit', MyModel.from_file(stream.name).muppet_name)
+            buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            my_model = MyModel.from_buffer(buffer)
+            buffer.close()
+        self.assertEquals('Kermit', my_model.muppet_name)
+        my_model.muppet_name = 'Fozzie'
+        self.assertEquals('Fozzie', MyModel(my_model.to_xml()).muppet_name)
+
+    def test_model_pickles_xml_and_parsed_values_without_dom(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value><age>3</age><age>4</age></kiddie></root>')
+        self.assertEquals('Gonzo', my_model.muppet_name)
+        my_model.muppet_type = 'frog'
+        for protocol in (0, 2):
+            restored = pickle.loads(pickle.dumps(my_model, protocol))
+            self.assertEquals(None, restored._dom)
+            self.assertEquals('Gonzo', restored.muppet_name)
+            self.assertEquals('frog', restored.muppet_type)
+            self.assertEquals(None, restored._dom)
+            self.assertEquals([3, 4], restored.muppet_ages)
+
+    def test_model_built_from_a_record_pickles_its_fragment(self):
+        document = [document for document in Listing._documents(StringIO('<Listings><Listing id="7"><Agent>Zoe</Agent></Listing></Listings>'))][0]
+        restored = pickle.loads(pickle.dumps(Listing._from_document(document), 2))
+        self.assertEquals(7, restored.listing_id)
+        self.assertEquals('Zoe', restored.agent)
+
+    def test_interned_char_fields_share_equal_values(self):
+        statuses = [Status('<status code="%s"><country>%s</country></status>' % pair)
+                    for pair in [('ACTIVE', 'CA'), ('ACTIVE', 'US'), ('CLOSED', 'CA'), ('CLOSED', 'US')]]
+        self.assertTrue(statuses[0].code is statuses[1].code)
+        self.assertTrue(statuses[2].code is statuses[3].code)
+        self.assertEquals('CLOSED', statuses[3].code)
+        self.assertTrue(statuses[0].country is statuses[2].country)
+        self.assertEquals('US', statuses[3].country)
+        self.assertFalse(statuses[1].country is statuses[3].country)
+
+    def test_collections_of_char_fields_can_intern_their_values(self):
+        first = Status('<status><tag>new</tag><tag>sale</tag></status>')
+        second = Status('<status><tag>sale</tag></status>')
+        self.assertEquals(['new', 'sale'], first.tags)
+        self.assertTrue(first.tags[1] is second.tags[0])
+        self.assertRaises(ValueError, Collection, IntField, xpath='/status/count', intern=True)
+
+    def test_compact_collections_hold_values_in_arrays(self):
+        series = Series('<series><reading count="1" at="1970-01-01T00:00:01">1.5</reading><reading count="3" at="1970-01-01T00:01:00"/></series>')
+        self.assertEquals(array.array('d', [1.5]), series.readings[:1])
+        self.assertTrue(math.isnan(series.readings[1]))
+        self.assertEquals(array.array('l', [1, 3]), series.counts)
+        self.assertEquals(array.array('d', [60.0]), series.busy)
+        self.assertEquals([1, 3], pickle.loads(pickle.dumps(series)).counts.tolist())
+        self.assertRaises(ValueError, Collection, CharField, xpath='/series/name', compact=True)
+
+    def test_compact_collections_widen_ints_with_missing_values(self):
+        class Ages(Model):
+            ages = Collection(IntField, xpath='/root/age', compact=True)
+            counted = Collection(IntField, xpath='/root/age', compact=True, missing=0)
+        model = Ages('<root><age>3</age><age/></root>')
+        self.assertEquals('d', model.ages.typecode)
+        self.assertEquals(3.0, model.ages[0])
+        self.assertTrue(math.isnan(model.ages[1]))
+        self.assertEquals(array.array('l', [3, 0]), model.counted)
+
+    @unittest.skipIf(not numpy_available, "requires NumPy")
+    def test_compact_collections_can_hold_values_in_numpy_arrays(self):
+        class NumpySeries(Model):
+            counts = Collection(IntField, xpath='/series/reading/@count', numpy=True)
+            times = Collection(DateField, xpath='/series/reading/@at', numpy=True)
+        series = NumpySeries('<series><reading count="1" at="1970-01-01T00:00:01"/><reading count="3"/></series>')
+        self.assertEquals([1, 3], series.counts.tolist())
+        self.assertEquals('1970-01-01T00:00:01.000000', str(series.times[0]))
+
+    def test_collections_can_be_streamed_from_a_file(self):
+        feed = StringIO('<root><kiddie><value>Gonzo</value><age>3</age><address><number>10</number></address><age>4</age>'
+                        '<address><number>5</number><city>Bedrock</city></address></kiddie></root>')
+        addresses = MyModel.stream('muppet_addresses', feed)
+        first = addresses.next()
+        self.assertEquals(10, first.number)
+        self.assertEquals([(5, 'Bedrock')], [(address.number, address.city) for address in addresses])
+        self.assertEquals(10, first.number)
+        self.assertEquals([3, 4], [age for age in MyModel.stream('muppet_ages', StringIO(feed.getvalue()))])
+        self.assertRaises(ValueError, MyModel.stream, 'muppet_name', feed)
+
+    def test_collections_can_be_streamed_from_a_response(self):
+        response = rest_client.Response('http://foo.com/feed', 200, {}, StringIO('<series><reading count="1">1.5</reading><reading>2</reading></series>'))
+        self.assertEquals([1.5, 2.0], [reading for reading in Collection(FloatField, xpath='/series/reading').stream(response.content)])
+        self.assertEquals([1.5], [value for value in Series.stream('readings', rest_client.Response('http://foo.com/feed', 200, {}, StringIO('<series><reading>1.5</reading></series>')))])
+
+    def test_collection_orders_by_sort_field_without_building_models(self):
+        my_model = MyModel('<root><kiddie><address><number>10</number></address><address><number>5</number></address><address><number>7</number></address></kiddie></root>')
+        addresses = my_model.muppet_addresses
+        self.assertEquals(7, addresses[1].number)
+        self.assertEquals(1, len([item for item in list.__iter__(addresses) if isinstance(item, Address)]))
+        self.assertEquals([5, 7, 10], [address.number for address in addresses])
+
+    def test_fields_that_override_parse_are_not_read_in_a_batch(self):
+        class ShoutingField(CharField):
+            def parse(self, xml, namespace):
+                return CharField.parse(self, xml, namespace).upper()
+        class Shouting(Model):
+            name = ShoutingField(xpath='/root/name')
+            other = CharField(xpath='/root/other')
+        shouting = Shouting('<root><name>x</name><other>y</other></root>')
+        self.assertEquals({'name': 'X', 'other': 'y'}, shouting.to_dict())
+        self.assertEquals('X', shouting.name)
+        class ShoutingInt(IntField):
+            def parse(self, xml, namespace):
+                return 1
+        self.assertRaises(ValueError, Collection, ShoutingInt, xpath='/root/age', compact=True)
+
+    def test_to_dict_reads_all_fields_and_converts_child_models(self):
+        my_model = MyModel('<root><kiddie><value>Gonzo</value><age>3</age><address><number>10</number><street>1st Ave. South</street></address>'
+                           '<address><number>5</number><city>Bedrock</city><foobar>foo</foobar></address></kiddie></root>')
+        my_model.muppet_type = 'bear'
+        self.assertEquals({'muppet_name': 'Gonzo', 'muppet_type': 'bear', 'muppet_names': ['Gonzo'], 'muppet_ages': [3],
+                           'muppet_addresses': [{'number': 5, 'street': None, 'city': 'Bedrock', 'foobars': ['foo']},
+                                                {'number': 10, 'street': '1st Ave. South', 'city': None, 'foobars': []}]},
+                          my_model.to_dict())
+        self.assertEquals({'sub_model': {'name': 'Ernie'}}, MasterModel('<master><sub><name>Ernie</name></sub></master>').to_dict())
+        self.assertEquals({'sub_model': None}, MasterModel('<master/>').to_dict())
+
+    def test_dump_jsonl_writes_a_line_per_model(self):
+        stream = StringIO()
+        dump_jsonl([Listing('<Listing id="1" listed="2008-06-21T10:36:12Z"><Agent>Fozzie</Agent></Listing>'), Phones('<person/>')], stream)
+        lines = stream.getvalue().splitlines()
+        self.assertEquals(2, len(lines))
+        self.assertEquals({'listing_id': 1, 'price': None, 'listed': '2008-06-21T10:36:12+00:00', 'agent': 'Fozzie'}, json.loads(lines[0]))
+        self.assertEquals({'home_phone': None, 'phone_number': None}, json.loads(lines[1]))
+
     def test_manager_noregisteredfindererror_raised_when_filter_on_non_existent_field(self):
         try:
             MyModel.objects.filter(foo="bar").count()
@@ -214,6 +608,33 @@ class XmlModelsTest(unittest.TestCase):
         except NoRegisteredFinderError, e:
             self.assertTrue("foo" in str(e))
 
+    def test_parse_many_builds_models_in_order_with_field_values_cached(self):
+        documents = ['<root><kiddie><value>%s</value><age>%d</age></kiddie></root>' % (name, age)
+                     for name, age in [('Gonzo', 3), ('Fozzie', 4), ('Rowlf', 5)]]
+        models = list(MyModel.parse_many(documents, workers=2, max_pending=1))
+        self.assertEquals(['Gonzo', 'Fozzie', 'Rowlf'], [m.muppet_name for m in models])
+        self.assertEquals([[3], [4], [5]], [m.muppet_ages for m in models])
+        self.assertEquals(None, models[0]._dom)
+        self.assertEquals([], models[0].muppet_addresses)
+
+    def test_parse_many_raises_validation_errors_from_workers(self):
+        try:
+            list(MyValidatingModel.parse_many(['<root/>'], workers=1))
+            self.fail("Expected XmlValidationError")
+        except XmlValidationError, e:
+            self.assertEquals("What, no muppet name?", str(e))
+
+    def test_field_variables_are_bound_in_xpath(self):
+        my_model = Phones('<person><phone type="home">123</phone><phone type="work">456</phone></person>')
+        self.assertEquals('123', my_model.home_phone)
+
+    def test_field_value_binds_supplied_variables_without_caching(self):
+        my_model = Phones('<person><phone type="home">123</phone><phone type="work">456</phone></person>')
+        self.assertEquals('456', my_model.field_value('home_phone', kind='work'))
+        self.assertEquals(456, my_model.field_value('phone_number', kind='work'))
+        self.assertEquals('123', my_model.home_phone)
+        self.assertEquals(None, my_model.field_value('phone_number', kind='mobile'))
+
     def test_should_handle_models_with_no_data(self):
         my_model = MyModel()
         my_model.muppet_name
@@ -236,6 +657,101 @@ class XmlModelsTest(unittest.TestCase):
         self.assertEquals(2, count)
         self.assertTrue(mock_get.called)
         
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_counts_the_records_it_iterates_over(self, mock_get):
+        class t:
+            def __init__(self):
+                self.content = StringIO('<items><item n="1"><item n="1a"/></item><item n="2"/></items>')
+        class Item(Model):
+            n = CharField(xpath='/item/@n')
+            finders = {(n,): "http://items/%s"}
+        mock_get.side_effect = lambda *args, **kw: t()
+        self.assertEquals(['1', '2'], [item.n for item in Item.objects.filter(n="x")])
+        self.assertEquals(2, Item.objects.filter(n="x").count())
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_exports_columns_of_field_values(self, mock_get):
+        class t:
+            content = StringIO('<listings><Listing id="1" price="9.5" listed="2008-06-21T10:36:12.5+02:00"><Agent>Fozzie</Agent></Listing>'
+                               '<Listing id="2" listed="1970-01-01T00:00:00"/></listings>')
+        mock_get.return_value = t()
+        columns = Listing.objects.filter(agent="Fozzie").to_columns(['listing_id', 'price', 'listed', 'agent'])
+        self.assertEquals(array.array('l', [1, 2]), columns['listing_id'])
+        self.assertEquals(9.5, columns['price'][0])
+        self.assertTrue(math.isnan(columns['price'][1]))
+        self.assertEquals(array.array('d', [1214037372.5, 0.0]), columns['listed'])
+        self.assertEquals(['Fozzie', None], columns['agent'])
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_exports_columns_with_missing_ints(self, mock_get):
+        class t:
+            def __init__(self, *args, **kw):
+                self.content = StringIO('<listings><Listing id="1"/><Listing/></listings>')
+        mock_get.side_effect = t
+        columns = Listing.objects.filter(agent="Fozzie").to_columns(['listing_id'])
+        self.assertEquals(1.0, columns['listing_id'][0])
+        self.assertTrue(math.isnan(columns['listing_id'][1]))
+        columns = Listing.objects.filter(agent="Fozzie").to_columns(['listing_id'], missing=-1)
+        self.assertEquals(array.array('l', [1, -1]), columns['listing_id'])
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_streams_rows_of_field_values(self, mock_get):
+        class t:
+            def __init__(self, *args, **kw):
+                self.content = StringIO('<listings><Listing id="1" price="9.5"><Agent>Fozzie</Agent></Listing><Listing id="2"/></listings>')
+        mock_get.side_effect = t
+        query = Listing.objects.filter(agent="Fozzie")
+        self.assertEquals([(1, 'Fozzie'), (2, None)], [row for row in query.values_list('listing_id', 'agent')])
+        self.assertEquals([9.5, None], [price for price in query.values_list('price', flat=True)])
+        rows = [row for row in query.values()]
+        self.assertEquals({'listing_id': 1, 'price': 9.5, 'listed': None, 'agent': 'Fozzie'}, rows[0])
+        self.assertRaises(TypeError, query.values_list, 'listing_id', 'agent', flat=True)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_only_reads_the_named_fields_and_keeps_no_document(self, mock_get):
+        class t:
+            content = StringIO('<listings><Listing id="1" price="9.5"><Agent>Fozzie</Agent></Listing><Listing id="2"/></listings>')
+        mock_get.return_value = t()
+        listings = [listing for listing in Listing.objects.filter(agent="Fozzie").only('listing_id', 'agent')]
+        self.assertEquals([1, 2], [listing.listing_id for listing in listings])
+        self.assertEquals(['Fozzie', None], [listing.agent for listing in listings])
+        self.assertEquals(None, listings[0]._dom)
+        self.assertRaises(DeferredFieldError, getattr, listings[0], 'price')
+        self.assertRaises(DeferredFieldError, listings[0].to_xml)
+        listings[0].price = 1.5
+        self.assertEquals(1.5, listings[0].price)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_only_validates_each_result(self, mock_get):
+        class t:
+            content = StringIO('<list><root><kiddie><value>Gonzo</value></kiddie></root><root><kiddie/></root></list>')
+        mock_get.return_value = t()
+        results = iter(MyValidatingModel.objects.filter(muppet_name="Gonzo").only('muppet_name'))
+        self.assertEquals('Gonzo', results.next().muppet_name)
+        self.assertRaises(XmlValidationError, results.next)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_defer_reads_all_but_the_named_fields(self, mock_get):
+        class t:
+            content = StringIO('<listings><Listing id="1" price="9.5"><Agent>Fozzie</Agent></Listing></listings>')
+        mock_get.return_value = t()
+        listing = [listing for listing in Listing.objects.filter(agent="Fozzie").defer('agent').defer('listed')][0]
+        self.assertEquals(9.5, listing.price)
+        self.assertRaises(DeferredFieldError, getattr, listing, 'agent')
+        self.assertRaises(DeferredFieldError, getattr, pickle.loads(pickle.dumps(listing)), 'listed')
+
+    @unittest.skipIf(not numpy_available, "requires NumPy")
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_exports_numpy_columns(self, mock_get):
+        class t:
+            content = StringIO('<listings><Listing id="1" listed="2008-06-21T10:36:12.5+02:00"/><Listing id="2"/></listings>')
+        mock_get.return_value = t()
+        columns = Listing.objects.filter(agent="Fozzie").to_columns(['listing_id', 'listed', 'agent'], numpy=True)
+        self.assertEquals([1, 2], columns['listing_id'].tolist())
+        self.assertEquals('2008-06-21T08:36:12.500000', str(columns['listed'][0]))
+        self.assertEquals('NaT', str(columns['listed'][1]))
+        self.assertEquals([None, None], columns['agent'].tolist())
+
     @patch.object(rest_client.Client, "GET")
     def test_manager_queries_rest_service_when_getting_for_a_registered_finder(self, mock_get):
         class t:
@@ -318,6 +834,21 @@ class XmlModelsTest(unittest.TestCase):
         self.assertEquals("hello", results[0].field1)
         self.assertEquals("goodbye", results[1].field1)
         
+    def test_list_documents_are_parsed_into_one_document_per_record(self):
+        records = xpath.domify_records(StringIO('<elems xmlns:p="urn:p"><root><field1>hello</field1></root><count>2</count>'
+                                                '<root><field1>goodbye</field1><p:x/></root></elems>'))
+        models = [Simple(dom=record) for record in records]
+        self.assertEquals(['hello', 'goodbye'], [model.field1 for model in models])
+        self.assertEquals(None, models[0]._xml)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_returns_models_usable_after_iteration(self, mock_get):
+        class t:
+            content = StringIO("<elems><root><field1>hello</field1></root><root><field1>goodbye</field1></root></elems>")
+        mock_get.return_value = t()
+        results = [model for model in Simple.objects.filter(field1="baz")]
+        self.assertEquals(["hello", "goodbye"], [model.field1 for model in results])
+
     @patch.object(rest_client.Client, "GET")
     def test_manager_returns_iterator_for_collection_of_results_from_custom_query(self, mock_get):
         class t:
@@ -428,6 +959,48 @@ class Simple(Model):
 class SimpleWithoutFinder(Model):
     field1 = CharField(xpath='/root/field1')
 
+class LoudSimple(Simple):
+    loud = CharField(xpath='/root/loud')
+
+class ExtendedSimple(LoudSimple):
+    __slots__ = ('__dict__',)
+    field2 = CharField(xpath='/root/field2')
+    loud = CharField(xpath='/root/field1')
+
+class UncachedSimple(Model):
+    cache_fields = False
+    field1 = CharField(xpath='/root/field1')
+
+class ReleasingSimple(Model):
+    release_document = 'dom'
+    field1 = CharField(xpath='/root/field1')
+    field2 = IntField(xpath='/root/field2')
+
+class ForgetfulSimple(ReleasingSimple):
+    release_document = 'all'
+
+class Status(Model):
+    code = CharField(xpath='/status/@code', intern=True)
+    country = CharField(xpath='/status/country', intern=1)
+    tags = Collection(CharField, xpath='/status/tag', intern=True)
+
+class Series(Model):
+    readings = Collection(FloatField, xpath='/series/reading', compact=True)
+    counts = Collection(IntField, xpath='/series/reading/@count', compact=True)
+    busy = Collection(DateField, xpath='/series/reading[@count > 1]/@at', compact=True)
+
+class Listing(Model):
+    listing_id = IntField(xpath='/Listing/@id')
+    price = FloatField(xpath='/Listing/@price')
+    listed = DateField(xpath='/Listing/@listed', tz_aware=True)
+    agent = CharField(xpath='/Listing/Agent')
+
+    finders = { (agent,): "http://foo.com/listings/%s" }
+
+class Phones(Model):
+    home_phone = CharField(xpath='/person/phone[@type=$kind]', variables={'kind': 'home'})
+    phone_number = IntField(xpath='/person/phone[@type=$kind]')
+
 class SubModel(Model):
     name = CharField(xpath='/sub/name')
 
@@ -1,10 +1,13 @@
 from xpath.exceptions import *
 import xpath.exceptions
 import xpath.expr
+import xpath.parallel
 import xpath.parser
+import xpath.profile
 import xpath.yappsrt
 
-__all__ = ['find', 'findnode', 'findvalue', 'XPathContext', 'XPath']
+__all__ = ['find', 'findnode', 'findvalue', 'findbatch', 'findmany', 'explain',
+           'parse', 'XPathContext', 'XPath', 'XPathBatch']
 __all__.extend((x for x in dir(xpath.exceptions) if not x.startswith('_')))
 
 def api(f):
@@ -30,11 +33,19 @@ class XPathContext(object):
         self.default_namespace = None
         self.namespaces = {}
         self.variables = {}
+        self.child_index = None
+        self.id_attributes = None
 
         if document is not None:
             if document.nodeType != document.DOCUMENT_NODE:
                 document = document.ownerDocument
-            if document.documentElement is not None:
+            if isinstance(document, xpath.expr.EtreeDocument):
+                for prefix, uri in document.namespaces.items():
+                    if prefix:
+                        self.namespaces[prefix] = uri
+                    else:
+                        self.default_namespace = uri
+            elif document.documentElement is not None:
                 attrs = document.documentElement.attributes
                 for attr in (attrs.item(i) for i in xrange(attrs.length)):
                     if attr.name == 'xmlns':
@@ -49,16 +60,19 @@ class XPathContext(object):
         dup.default_namespace = self.default_namespace
         dup.namespaces.update(self.namespaces)
         dup.variables.update(self.variables)
+        dup.id_attributes = self.id_attributes
         return dup
 
     def update(self, default_namespace=None, namespaces=None,
-                  variables=None, **kwargs):
+                  variables=None, id_attributes=None, **kwargs):
         if default_namespace is not None:
             self.default_namespace = default_namespace
         if namespaces is not None:
             self.namespaces = namespaces
         if variables is not None:
             self.variables = variables
+        if id_attributes is not None:
+            self.id_attributes = id_attributes
         self.variables.update(kwargs)
 
     @api
@@ -81,14 +95,22 @@ class XPath():
     _max_cache = 100
     _cache = {}
 
-    def __init__(self, expr):
-        """Init docs.
+    def __init__(self, expr, profile=False):
+        """Parse an expression.
+
+        When profile is true, every node of the expression is instrumented
+        to record call counts, nodes visited and emitted, and time spent.
+        The results are rendered by explain().
+
         """
         try:
             parser = xpath.parser.XPath(xpath.parser.XPathScanner(str(expr)))
             self.expr = parser.XPath()
         except xpath.yappsrt.SyntaxError, e:
             raise XPathParseError(str(expr), e.pos, e.msg)
+        self.profile = None
+        if profile:
+            self.profile = xpath.profile.Profile(self.expr)
 
     @classmethod
     def get(cls, s):
@@ -137,6 +159,13 @@ class XPath():
             raise XPathTypeError("expression is not a node-set")
         return [xpath.expr.string_value(x) for x in result]
 
+    def explain(self):
+        """Return the expression plan, annotated with profile counters if
+        the expression is being profiled."""
+        if self.profile is not None:
+            return self.profile.explain()
+        return xpath.profile.plan(self.expr)
+
     def __repr__(self):
         return '%s.%s(%s)' % (self.__class__.__module__,
                               self.__class__.__name__,
@@ -145,6 +174,77 @@ class XPath():
     def __str__(self):
         return str(self.expr)
 
+class XPathBatch(object):
+    """A set of XPath expressions evaluated together against one node.
+
+    The location paths in the set are merged into a prefix trie, so that a
+    prefix shared by several expressions (e.g. /Person/Addresses/Address) is
+    only walked once.  Expressions which are not plain location paths are
+    evaluated individually.
+
+    """
+    _max_cache = 100
+    _cache = {}
+
+    def __init__(self, exprs):
+        self.xpaths = [XPath.get(x) for x in exprs]
+        self.absolute = xpath.expr.PathTrie()
+        self.relative = xpath.expr.PathTrie()
+        self.others = []
+        for i, x in enumerate(self.xpaths):
+            path = xpath.expr.location_steps(x.expr)
+            if path is None:
+                self.others.append(i)
+            elif path[0]:
+                self.absolute.add(path[1], i)
+            else:
+                self.relative.add(path[1], i)
+
+    @classmethod
+    def get(cls, exprs):
+        if isinstance(exprs, cls):
+            return exprs
+        key = tuple(str(x) for x in exprs)
+        try:
+            return cls._cache[key]
+        except KeyError:
+            if len(cls._cache) > cls._max_cache:
+                cls._cache.clear()
+            batch = cls(exprs)
+            cls._cache[key] = batch
+            return batch
+
+    @api
+    def find(self, node, context=None, **kwargs):
+        """Return a list holding the result of each expression, in the
+        order the expressions were given."""
+        if context is None:
+            context = XPathContext(node, **kwargs)
+        else:
+            context = context.clone()
+            context.update(**kwargs)
+        # Index element children by name, as the expressions in the batch
+        # typically look up several siblings under the same elements.
+        context.child_index = {}
+        results = [None] * len(self.xpaths)
+        self.relative.evaluate([node], context, results)
+        if self.absolute.children or self.absolute.indexes:
+            root = node
+            if root.nodeType != root.DOCUMENT_NODE:
+                root = root.ownerDocument
+            self.absolute.evaluate([root], context, results)
+        for i in self.others:
+            results[i] = self.xpaths[i].expr.evaluate(node, 1, 1, context)
+        return results
+
+    def __len__(self):
+        return len(self.xpaths)
+
+    def __repr__(self):
+        return '%s.%s(%s)' % (self.__class__.__module__,
+                              self.__class__.__name__,
+                              repr([str(x) for x in self.xpaths]))
+
 @api
 def find(expr, node, **kwargs):
     return XPath.get(expr).find(node, **kwargs)
@@ -160,3 +260,22 @@ def findvalue(expr, node, **kwargs):
 @api
 def findvalues(expr, node, **kwargs):
     return XPath.get(expr).findvalues(node, **kwargs)
+
+@api
+def explain(expr, node, **kwargs):
+    """Evaluate expr once against node with profiling enabled, and return
+    the annotated plan."""
+    x = XPath(str(expr), profile=True)
+    x.find(node, **kwargs)
+    return x.explain()
+
+@api
+def findbatch(exprs, node, **kwargs):
+    return XPathBatch.get(exprs).find(node, **kwargs)
+
+findmany = xpath.parallel.findmany
+
+def parse(text):
+    """Parse an XML string with the C ElementTree parser, returning a
+    document node the engine can query without building a minidom tree."""
+    return xpath.expr.EtreeDocument.fromstring(text)
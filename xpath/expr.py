@@ -157,6 +157,23 @@ class Expr(object):
 
         """
 
+    # The following methods evaluate the expression and aggregate the
+    # result.  Location paths override them to avoid building node-sets.
+
+    def evaluate_boolean(self, node, pos, size, context):
+        """Evaluate the expression and convert the result to a boolean."""
+        return boolean(self.evaluate(node, pos, size, context))
+
+    def evaluate_count(self, node, pos, size, context):
+        """Evaluate the expression and count the nodes in the result."""
+        return len(nodeset(self.evaluate(node, pos, size, context)))
+
+    def evaluate_sum(self, node, pos, size, context):
+        """Evaluate the expression and sum the numeric values of the nodes
+        in the result."""
+        nodes = nodeset(self.evaluate(node, pos, size, context))
+        return sum((number(string_value(x)) for x in nodes))
+
 class BinaryOperatorExpr(Expr):
     """Base class for all binary operators."""
 
@@ -178,16 +195,16 @@ class AndExpr(BinaryOperatorExpr):
 
     def evaluate(self, node, pos, size, context):
         # Note that XPath boolean operations short-circuit.
-        return (boolean(self.left.evaluate(node, pos, size, context) and
-                boolean(self.right.evaluate(node, pos, size, context))))
+        return (self.left.evaluate_boolean(node, pos, size, context) and
+                self.right.evaluate_boolean(node, pos, size, context))
 
 class OrExpr(BinaryOperatorExpr):
     """<x> or <y>"""
 
     def evaluate(self, node, pos, size, context):
         # Note that XPath boolean operations short-circuit.
-        return (boolean(self.left.evaluate(node, pos, size, context) or
-                boolean(self.right.evaluate(node, pos, size, context))))
+        return (self.left.evaluate_boolean(node, pos, size, context) or
+                self.right.evaluate_boolean(node, pos, size, context))
 
 class EqualityExpr(BinaryOperatorExpr):
     """<x> = <y>, <x> != <y>, etc."""
@@ -341,7 +358,8 @@ class Function(Expr):
     # parameters.
     #
 
-    def function(minargs, maxargs, implicit=False, first=False, convert=None):
+    def function(minargs, maxargs, implicit=False, first=False, convert=None,
+                 raw=False):
         """Function decorator.
 
         minargs -- Minimum number of arguments taken by the function.
@@ -350,10 +368,14 @@ class Function(Expr):
                     of the current context node when passed no argument.
                     (e.g., string() and number().)
         convert -- When non-None, a function used to filter function arguments.
+        raw -- True for functions which are passed their argument expressions
+               unevaluated.
         """
         def decorator(f):
             def new_f(self, node, pos, size, context):
-                if implicit and len(self.args) == 0:
+                if raw:
+                    args = self.args
+                elif implicit and len(self.args) == 0:
                     args = [[node]]
                 else:
                     args = [x.evaluate(node, pos, size, context)
@@ -385,19 +407,25 @@ class Function(Expr):
     def f_position(self, node, pos, size, context):
         return pos
 
-    @function(1, 1, convert=nodeset)
-    def f_count(self, node, pos, size, context, nodes):
-        return len(nodes)
+    @function(1, 1, raw=True)
+    def f_count(self, node, pos, size, context, expr):
+        return expr.evaluate_count(node, pos, size, context)
 
     @function(1, 1)
     def f_id(self, node, pos, size, context, arg):
         if nodesetp(arg):
-            ids = (string_value(x) for x in arg)
+            ids = chain.from_iterable(string_value(x).split() for x in arg)
         else:
-            ids = [string(arg)]
+            ids = string(arg).split()
         if node.nodeType != node.DOCUMENT_NODE:
             node = node.ownerDocument
-        return list(filter(None, (node.getElementById(id) for id in ids)))
+        if context.id_attributes is None:
+            return list(filter(None, (node.getElementById(id) for id in ids)))
+        index = id_index(node, context.id_attributes)
+        found = [index[id] for id in ids if id in index]
+        if len(found) > 1:
+            found = sorted(set(found))
+        return [element for position, element in found]
 
     @function(0, 1, implicit=True, first=True)
     def f_local_name(self, node, pos, size, context, argnode):
@@ -512,13 +540,13 @@ class Function(Expr):
 
     # Boolean functions
 
-    @function(1, 1, convert=boolean)
-    def f_boolean(self, node, pos, size, context, b):
-        return b
+    @function(1, 1, raw=True)
+    def f_boolean(self, node, pos, size, context, expr):
+        return expr.evaluate_boolean(node, pos, size, context)
 
-    @function(1, 1, convert=boolean)
-    def f_not(self, node, pos, size, context, b):
-        return not b
+    @function(1, 1, raw=True)
+    def f_not(self, node, pos, size, context, expr):
+        return not expr.evaluate_boolean(node, pos, size, context)
 
     @function(0, 0)
     def f_true(self, node, pos, size, context):
@@ -545,9 +573,9 @@ class Function(Expr):
     def f_number(self, node, pos, size, context, n):
         return n
 
-    @function(1, 1, convert=nodeset)
-    def f_sum(self, node, pos, size, context, nodes):
-        return sum((number(string_value(x)) for x in nodes))
+    @function(1, 1, raw=True)
+    def f_sum(self, node, pos, size, context, expr):
+        return expr.evaluate_sum(node, pos, size, context)
 
     @function(1, 1, convert=number)
     def f_floor(self, node, pos, size, context, n):
@@ -699,12 +727,103 @@ def merge_into_nodeset(target, source):
         target.extend(source)
         target.sort(key=document_order)
 
-class AbsolutePathExpr(Expr):
+def id_index(document, names):
+    """Return a dict mapping the IDs in a document to (position, element)
+    pairs, where position is the element's index in document order.
+
+    'names' is a sequence of attribute names, such as 'id' or 'xml:id',
+    whose values are treated as IDs.  The index is built on first use and
+    kept on the document, in its _id_indexes attribute, so it does not
+    reflect later changes to the tree.  Where several elements share an ID,
+    the first in document order is used.
+
+    """
+    names = tuple(names)
+    indexes = document.__dict__.get('_id_indexes')
+    if indexes is None:
+        indexes = document._id_indexes = {}
+    try:
+        return indexes[names]
+    except KeyError:
+        pass
+
+    index = indexes[names] = {}
+    stack = [document.documentElement]
+    position = 0
+    while stack:
+        node = stack.pop()
+        for name in names:
+            if node.hasAttribute(name):
+                index.setdefault(node.getAttribute(name), (position, node))
+        position += 1
+        stack.extend(reversed([n for n in node.childNodes
+                               if n.nodeType == n.ELEMENT_NODE]))
+    return index
+
+def walk_steps(steps, i, node, context):
+    """Lazily select the nodes reached from 'node' by steps[i:].
+
+    Each context node is walked depth first, so the nodes come out neither
+    deduplicated nor in document order.
+
+    """
+    nodes = steps[i].evaluate(node, 1, 1, context)
+    if i == len(steps) - 1:
+        return iter(nodes)
+    return chain.from_iterable((walk_steps(steps, i+1, n, context)
+                                for n in nodes))
+
+def unique(nodes):
+    """Filter duplicate nodes out of an iterable."""
+    seen = set()
+    for n in nodes:
+        if n not in seen:
+            seen.add(n)
+            yield n
+
+class LocationPath(Expr):
+    """Base class for location paths, which can count, sum and test their
+    nodes as they are selected instead of building a node-set."""
+
+    def iter_nodes(self, node, pos, size, context):
+        """Return an iterator over the distinct nodes selected by the path,
+        in no particular order, or None if the path cannot be walked lazily.
+
+        """
+
+    def evaluate_boolean(self, node, pos, size, context):
+        nodes = self.iter_nodes(node, pos, size, context)
+        if nodes is None:
+            return Expr.evaluate_boolean(self, node, pos, size, context)
+        for n in nodes:
+            return True
+        return False
+
+    def evaluate_count(self, node, pos, size, context):
+        nodes = self.iter_nodes(node, pos, size, context)
+        if nodes is None:
+            return Expr.evaluate_count(self, node, pos, size, context)
+        return sum((1 for n in nodes))
+
+    def evaluate_sum(self, node, pos, size, context):
+        nodes = self.iter_nodes(node, pos, size, context)
+        if nodes is None:
+            return Expr.evaluate_sum(self, node, pos, size, context)
+        return sum((number(string_value(x)) for x in nodes))
+
+class AbsolutePathExpr(LocationPath):
     """Absolute location paths."""
 
     def __init__(self, path):
         self.path = path
 
+    def iter_nodes(self, node, pos, size, context):
+        if node.nodeType != node.DOCUMENT_NODE:
+            node = node.ownerDocument
+        if self.path is None:
+            return iter([node])
+        return self.path.iter_nodes(node, 1, 1, context)
+
     def evaluate(self, node, pos, size, context):
         if node.nodeType != node.DOCUMENT_NODE:
             node = node.ownerDocument
@@ -715,12 +834,39 @@ class AbsolutePathExpr(Expr):
     def __str__(self):
         return '/%s' % (self.path or '')
 
-class PathExpr(Expr):
+class PathExpr(LocationPath):
     """Location path expressions."""
 
     def __init__(self, steps):
         self.steps = steps
 
+    def iter_nodes(self, node, pos, size, context):
+        try:
+            walkable, distinct = self._walk
+        except AttributeError:
+            walkable, distinct = self._walk = self._walk_plan()
+        if not walkable:
+            return None
+        nodes = walk_steps(self.steps, 0, node, context)
+        if not distinct:
+            return unique(nodes)
+        return nodes
+
+    def _walk_plan(self):
+        # The plan is worked out on first use, since the parser may still
+        # insert steps after the PathExpr is constructed.
+        if location_steps(self) is None:
+            return (False, False)
+
+        # Distinct nodes have distinct children, attributes and selves, so
+        # only other axes can reach the same node twice.
+        for step in self.steps[1:]:
+            if isinstance(step, PredicateList):
+                step = step.expr
+            if step.axis.__name__ not in ('child', 'attribute', 'self'):
+                return (True, False)
+        return (True, True)
+
     def evaluate(self, node, pos, size, context):
         # The first step in the path is evaluated in the current context.
         # If this is the only step in the path, the return value is
@@ -746,6 +892,65 @@ class PathExpr(Expr):
     def __str__(self):
         return '/'.join((str(s) for s in self.steps))
 
+def location_steps(expr):
+    """Split a location path into its steps.
+
+    Returns a tuple (absolute, steps), or None if 'expr' is not a location
+    path made up solely of axis steps (optionally with predicates).
+
+    """
+    absolute = isinstance(expr, AbsolutePathExpr)
+    if absolute:
+        expr = expr.path
+        if expr is None:
+            return (True, [])
+    if not isinstance(expr, PathExpr):
+        return None
+    for step in expr.steps:
+        if isinstance(step, PredicateList):
+            step = step.expr
+        if not isinstance(step, AxisStep):
+            return None
+    return (absolute, expr.steps)
+
+class PathTrie(object):
+    """A prefix trie of location path steps.
+
+    Each path added to the trie is tagged with an index.  Evaluating the
+    trie walks every distinct prefix once and stores the node-set for each
+    path in the results list at the path's index.
+
+    """
+    def __init__(self):
+        self.children = {}
+        self.order = []
+        self.indexes = []
+
+    def add(self, steps, index):
+        trie = self
+        for step in steps:
+            key = str(step)
+            try:
+                trie = trie.children[key][1]
+            except KeyError:
+                child = PathTrie()
+                trie.children[key] = (step, child)
+                trie.order.append(key)
+                trie = child
+        trie.indexes.append(index)
+
+    def evaluate(self, nodes, context, results):
+        for index in self.indexes:
+            results[index] = list(nodes)
+        for key in self.order:
+            step, child = self.children[key]
+            aggregate = []
+            for i in xrange(len(nodes)):
+                merge_into_nodeset(aggregate,
+                                   step.evaluate(nodes[i], i+1, len(nodes),
+                                                 context))
+            child.evaluate(aggregate, context, results)
+
 class PredicateList(Expr):
     """A list of predicates.
     
@@ -758,6 +963,11 @@ class PredicateList(Expr):
         self.expr = expr
         self.axis = axes[axis]
 
+        # Location path predicates always yield node-sets, and so are only
+        # tested for being non-empty.
+        self.paths = [location_steps(pred) is not None
+                      for pred in predicates]
+
     def evaluate(self, node, pos, size, context):
         result = self.expr.evaluate(node, pos, size, context)
         if not nodesetp(result):
@@ -766,9 +976,13 @@ class PredicateList(Expr):
         if self.axis.reverse:
             result.reverse()
 
-        for pred in self.predicates:
+        for pred, path in izip(self.predicates, self.paths):
             match = []
             for i, node in izip(count(1), result):
+                if path:
+                    if pred.evaluate_boolean(node, i, len(result), context):
+                        match.append(node)
+                    continue
                 r = pred.evaluate(node, i, len(result), context)
 
                 # If a predicate evaluates to a number, select the node
@@ -801,11 +1015,57 @@ class AxisStep(Expr):
         self.axis = axes[axis]
         self.test = test
 
+        # Steps selecting a concrete name along the attribute or child axis
+        # are answered by lookup rather than by scanning the axis.
+        self.lookup = None
+        if isinstance(test, NameTest) and test.localName != '*':
+            if axis == 'attribute':
+                self.lookup = self._attribute_lookup
+            elif axis == 'child':
+                self.lookup = self._child_lookup
+
+    def _attribute_lookup(self, node, context):
+        namespaceURI = self.test.namespace_uri(self.axis, context)
+        if namespaceURI == '*':
+            return None
+        if node.nodeType != node.ELEMENT_NODE:
+            return []
+        attr = node.getAttributeNodeNS(namespaceURI, self.test.localName)
+        if attr is None:
+            return []
+        return [attr]
+
+    def _child_lookup(self, node, context):
+        # When the context carries a child index (as it does while a batch
+        # of expressions is evaluated), the element children of each node
+        # are indexed by name the first time they are searched, so that
+        # sibling lookups under the same node do not rescan the children.
+        index = context.child_index
+        if index is None:
+            return None
+        namespaceURI = self.test.namespace_uri(self.axis, context)
+        if namespaceURI == '*':
+            return None
+        try:
+            table = index[node]
+        except KeyError:
+            table = index[node] = {}
+            for child in node.childNodes:
+                if child.nodeType == child.ELEMENT_NODE:
+                    key = (child.namespaceURI, child.localName)
+                    table.setdefault(key, []).append(child)
+        return list(table.get((namespaceURI, self.test.localName), ()))
+
     def evaluate(self, node, pos, size, context):
-        match = []
-        for n in self.axis(node):
-            if self.test.match(n, self.axis, context):
-                match.append(n)
+        # A lookup returns None when it cannot answer for this context, in
+        # which case the axis is scanned.
+        if self.lookup is not None:
+            match = self.lookup(node, context)
+            if match is not None:
+                return match
+
+        matcher = self.test.matcher(self.axis, context)
+        match = [n for n in self.axis(node) if matcher(n)]
 
         if self.axis.reverse:
             match.reverse()
@@ -825,32 +1085,92 @@ class Test(object):
     def match(self, node, axis, context):
         """Return True if 'node' matches the test along 'axis'."""
 
-class NameTest(object):
+    def matcher(self, axis, context):
+        """Return a function of a single node which is equivalent to
+        match() along 'axis' in 'context'.
+
+        Subclasses override this to return a matcher specialized for the
+        axis and context, so that per-node work is kept to a minimum.
+
+        """
+        return lambda node: self.match(node, axis, context)
+
+def _any_node(node):
+    return True
+
+class NameTest(Test):
+    _max_matchers = 100
+
     def __init__(self, prefix, localpart):
         self.prefix = prefix
         self.localName = localpart
         if self.prefix == None and self.localName == '*':
             self.prefix = '*'
+        self._matchers = {}
 
     def match(self, node, axis, context):
         if node.nodeType != axis.principal_node_type:
             return False
+        return self.matcher(axis, context)(node)
 
-        if self.prefix != '*':
-            namespaceURI = None
-            if self.prefix is not None:
-                try:
-                    namespaceURI = context.namespaces[self.prefix]
-                except KeyError:
-                    raise XPathUnknownPrefixError(self.prefix)
-            elif axis.principal_node_type == node.ELEMENT_NODE:
-                namespaceURI = context.default_namespace
-            if namespaceURI != node.namespaceURI:
-                return False
-        if self.localName != '*':
-            if self.localName != node.localName:
-                return False
-        return True
+    def namespace_uri(self, axis, context):
+        """Resolve the namespace URI this test matches along 'axis'.
+
+        Returns '*' when the test matches any namespace.
+
+        """
+        if self.prefix == '*':
+            return '*'
+        if self.prefix is not None:
+            try:
+                return context.namespaces[self.prefix]
+            except KeyError:
+                # The xml prefix is bound in every document.
+                if self.prefix == 'xml':
+                    return XML_NAMESPACE
+                raise XPathUnknownPrefixError(self.prefix)
+        if axis.principal_node_type == xml.dom.Node.ELEMENT_NODE:
+            return context.default_namespace
+        return None
+
+    def matcher(self, axis, context):
+        # Prefixes are resolved once per step evaluation, and the resulting
+        # matcher is memoized on the resolved namespace URI, for a bounded
+        # number of URIs.
+        key = (axis.principal_node_type, self.namespace_uri(axis, context))
+        try:
+            return self._matchers[key]
+        except KeyError:
+            if len(self._matchers) > self._max_matchers:
+                self._matchers.clear()
+            m = self._matchers[key] = self._specialize(*key)
+            return m
+
+    def _specialize(self, node_type, namespaceURI):
+        localName = self.localName
+        if node_type == xml.dom.Node.ATTRIBUTE_NODE:
+            # The attribute axis yields nothing but attributes, so the
+            # node type need not be checked.
+            if namespaceURI == '*':
+                if localName == '*':
+                    return _any_node
+                return lambda node: node.localName == localName
+            if localName == '*':
+                return lambda node: node.namespaceURI == namespaceURI
+            return lambda node: (node.localName == localName and
+                                 node.namespaceURI == namespaceURI)
+
+        if namespaceURI == '*':
+            if localName == '*':
+                return lambda node: node.nodeType == node_type
+            return lambda node: (node.nodeType == node_type and
+                                 node.localName == localName)
+        if localName == '*':
+            return lambda node: (node.nodeType == node_type and
+                                 node.namespaceURI == namespaceURI)
+        return lambda node: (node.nodeType == node_type and
+                             node.localName == localName and
+                             node.namespaceURI == namespaceURI)
 
     def __str__(self):
         if self.prefix is not None:
@@ -858,7 +1178,7 @@ class NameTest(object):
         else:
             return self.localName
 
-class PITest(object):
+class PITest(Test):
     def __init__(self, name=None):
         self.name = name
 
@@ -875,23 +1195,404 @@ class PITest(object):
             name = "'%s'" % self.name
         return 'processing-instruction(%s)' % name
 
-class CommentTest(object):
+class CommentTest(Test):
     def match(self, node, axis, context):
         return node.nodeType == node.COMMENT_NODE
 
+    def matcher(self, axis, context):
+        return lambda node: node.nodeType == node.COMMENT_NODE
+
     def __str__(self):
         return 'comment()'
 
-class TextTest(object):
+class TextTest(Test):
     def match(self, node, axis, context):
         return node.nodeType == node.TEXT_NODE
 
+    def matcher(self, axis, context):
+        return lambda node: node.nodeType == node.TEXT_NODE
+
     def __str__(self):
         return 'text()'
 
-class AnyKindTest(object):
+class AnyKindTest(Test):
     def match(self, node, axis, context):
         return True
 
+    def matcher(self, axis, context):
+        return _any_node
+
     def __str__(self):
         return 'node()'
+
+#
+# ElementTree adapter.
+#
+# The engine walks trees through the subset of the DOM interface used
+# above.  The classes below present an xml.etree.ElementTree tree through
+# that interface, so that documents parsed by the C ElementTree parser can
+# be queried without building a minidom tree.  Wrappers are created lazily
+# as the tree is walked, and are cached so that each node is represented by
+# a single wrapper.
+#
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+from xml.etree import ElementTree as PyElementTree
+from xml.sax.saxutils import escape
+from StringIO import StringIO
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+def etree_text(value):
+    """Return an ElementTree text or attribute value as unicode.  The C
+    parser returns ASCII values as str."""
+    if isinstance(value, str):
+        return unicode(value)
+    return value
+
+def iterparse_scoped(source):
+    """Parse source, a file object or file name, with the C ElementTree
+    parser, yielding ('start', element, namespaces) and ('end', element,
+    namespaces) for each element.  'namespaces' maps the prefixes in scope
+    at the element to their URIs, with '' for the default namespace, and is
+    the same dict as its parent's unless the element declares namespaces of
+    its own."""
+    scopes = [{}]
+    declared = None
+    for event, item in ElementTree.iterparse(source,
+                                             ('start', 'end', 'start-ns')):
+        if event == 'start-ns':
+            if declared is None:
+                declared = dict(scopes[-1])
+            declared[item[0]] = item[1]
+        elif event == 'start':
+            if declared is not None:
+                scopes.append(declared)
+                declared = None
+            else:
+                scopes.append(scopes[-1])
+            yield event, item, scopes[-1]
+        else:
+            yield event, item, scopes.pop()
+
+def tostring(element, namespaces=None):
+    """Serialize an ElementTree element, without its tail, as a unicode
+    string.  Names are written with the prefixes 'namespaces' maps to their
+    URIs, with '' for the default namespace, and the prefixes used are
+    declared on the element.  ElementTree itself would write a default
+    namespace as a generated prefix, which changes how unprefixed names in
+    expressions match the document when it is parsed again."""
+    prefixes = {XML_NAMESPACE: 'xml'}
+    for prefix, uri in sorted((namespaces or {}).items(), reverse=True):
+        prefixes.setdefault(uri, prefix)
+    element_uris, attribute_uris, unqualified = set(), set(), False
+    for node in element.iter():
+        if not isinstance(node.tag, basestring):
+            continue
+        uri = split_qname(node.tag)[0]
+        if uri is None:
+            unqualified = True
+        else:
+            element_uris.add(uri)
+        for key in node.keys():
+            uri = split_qname(key)[0]
+            if uri is not None:
+                attribute_uris.add(uri)
+    default = (namespaces or {}).get('')
+    if unqualified or default not in element_uris:
+        default = None
+    qualifiers = {}
+    for uri in sorted(element_uris | attribute_uris):
+        prefix = prefixes.get(uri)
+        if uri == default and uri not in attribute_uris:
+            continue
+        if not prefix:
+            prefix = 'ns%d' % len(qualifiers)
+        qualifiers[uri] = prefix
+    declarations = [(u'xmlns:' + prefix, uri)
+                    for uri, prefix in sorted(qualifiers.items())
+                    if uri != XML_NAMESPACE]
+    if default is not None:
+        declarations.insert(0, (u'xmlns', default))
+    out = []
+    _write_element(out.append, element, default, qualifiers, declarations)
+    return u''.join(out)
+
+def _qualified_name(name, default, qualifiers, attribute=False):
+    uri, local = split_qname(name)
+    if uri is None or (uri == default and not attribute):
+        return local
+    return u'%s:%s' % (qualifiers[uri], local)
+
+_attribute_entities = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;',
+                       '\t': '&#09;'}
+
+def _write_element(write, element, default, qualifiers, declarations=()):
+    tag = element.tag
+    if tag is PyElementTree.Comment:
+        write(u'<!--%s-->' % etree_text(element.text))
+        return
+    if tag is PyElementTree.ProcessingInstruction:
+        write(u'<?%s?>' % etree_text(element.text))
+        return
+    name = _qualified_name(tag, default, qualifiers)
+    write(u'<' + name)
+    for key, value in declarations:
+        write(u' %s="%s"' % (key, escape(value, _attribute_entities)))
+    for key, value in sorted(element.items()):
+        write(u' %s="%s"' % (_qualified_name(key, default, qualifiers, True),
+                             escape(etree_text(value), _attribute_entities)))
+    if element.text or len(element):
+        write(u'>')
+        if element.text:
+            write(escape(etree_text(element.text)))
+        for child in element:
+            _write_element(write, child, default, qualifiers)
+            if child.tail:
+                write(escape(etree_text(child.tail)))
+        write(u'</%s>' % name)
+    else:
+        write(u' />')
+
+def split_qname(name):
+    """Split an ElementTree '{uri}local' name into (uri, local)."""
+    if name[:1] == '{':
+        uri, local = name[1:].split('}', 1)
+        return uri, local
+    return None, name
+
+class EtreeNode(object):
+    """Base class for the DOM-like ElementTree node wrappers."""
+
+    ELEMENT_NODE = xml.dom.Node.ELEMENT_NODE
+    ATTRIBUTE_NODE = xml.dom.Node.ATTRIBUTE_NODE
+    TEXT_NODE = xml.dom.Node.TEXT_NODE
+    PROCESSING_INSTRUCTION_NODE = xml.dom.Node.PROCESSING_INSTRUCTION_NODE
+    COMMENT_NODE = xml.dom.Node.COMMENT_NODE
+    DOCUMENT_NODE = xml.dom.Node.DOCUMENT_NODE
+
+    parentNode = None
+    ownerDocument = None
+    attributes = None
+    namespaceURI = None
+    localName = None
+    childNodes = ()
+    _index = 0
+
+    @property
+    def firstChild(self):
+        if self.childNodes:
+            return self.childNodes[0]
+        return None
+
+    @property
+    def previousSibling(self):
+        if self.parentNode is None or self._index == 0:
+            return None
+        return self.parentNode.childNodes[self._index - 1]
+
+    @property
+    def nextSibling(self):
+        if self.parentNode is None:
+            return None
+        siblings = self.parentNode.childNodes
+        if self._index + 1 < len(siblings):
+            return siblings[self._index + 1]
+        return None
+
+class EtreeText(EtreeNode):
+    nodeType = EtreeNode.TEXT_NODE
+
+    def __init__(self, data, parent, index):
+        self.data = self.nodeValue = etree_text(data)
+        self.parentNode = parent
+        self.ownerDocument = parent.ownerDocument
+        self._index = index
+
+    def toxml(self):
+        return escape(self.data)
+
+class EtreeComment(EtreeText):
+    nodeType = EtreeNode.COMMENT_NODE
+
+    def toxml(self):
+        return '<!--%s-->' % self.data
+
+class EtreeProcessingInstruction(EtreeText):
+    nodeType = EtreeNode.PROCESSING_INSTRUCTION_NODE
+
+    def __init__(self, data, parent, index):
+        self.target, _, data = data.partition(' ')
+        EtreeText.__init__(self, data, parent, index)
+
+    def toxml(self):
+        return '<?%s %s?>' % (self.target, self.data)
+
+class EtreeAttribute(EtreeNode):
+    nodeType = EtreeNode.ATTRIBUTE_NODE
+
+    def __init__(self, key, value, element):
+        self.namespaceURI, self.localName = split_qname(key)
+        self.name = self.localName
+        if self.namespaceURI == XML_NAMESPACE:
+            self.name = 'xml:' + self.localName
+        self.value = self.nodeValue = etree_text(value)
+        self.ownerElement = element
+        self.ownerDocument = element.ownerDocument
+
+    @property
+    def childNodes(self):
+        return [EtreeText(self.value, self, 0)]
+
+    def toxml(self):
+        return '%s="%s"' % (self.name, escape(self.value, {'"': '&quot;'}))
+
+class EtreeAttributes(object):
+    """The attributes of an element, as a minimal NamedNodeMap."""
+
+    def __init__(self, element):
+        self._attrs = [EtreeAttribute(k, v, element)
+                       for k, v in element.element.items()]
+        self.length = len(self._attrs)
+        self.names = dict(((a.namespaceURI, a.localName), a)
+                          for a in self._attrs)
+
+    def item(self, i):
+        return self._attrs[i]
+
+class EtreeElement(EtreeNode):
+    nodeType = EtreeNode.ELEMENT_NODE
+
+    def __init__(self, element, parent, index):
+        self.element = element
+        self.parentNode = parent
+        self.ownerDocument = parent.ownerDocument or parent
+        self._index = index
+        self.namespaceURI, self.localName = split_qname(element.tag)
+        self.tagName = self.localName
+        self._children = None
+        self._attributes = None
+
+    @property
+    def childNodes(self):
+        if self._children is None:
+            nodes = self._children = []
+            if self.element.text:
+                nodes.append(EtreeText(self.element.text, self, 0))
+            for child in self.element:
+                if child.tag is PyElementTree.Comment:
+                    nodes.append(EtreeComment(child.text, self, len(nodes)))
+                elif child.tag is PyElementTree.ProcessingInstruction:
+                    nodes.append(EtreeProcessingInstruction(child.text, self,
+                                                            len(nodes)))
+                else:
+                    nodes.append(EtreeElement(child, self, len(nodes)))
+                if child.tail:
+                    nodes.append(EtreeText(child.tail, self, len(nodes)))
+        return self._children
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = EtreeAttributes(self)
+        return self._attributes
+
+    def getAttributeNodeNS(self, namespaceURI, localName):
+        if not self.element.attrib:
+            return None
+        return self.attributes.names.get((namespaceURI or None, localName))
+
+    def _key(self, name):
+        if name.startswith('xml:'):
+            return '{%s}%s' % (XML_NAMESPACE, name[4:])
+        return name
+
+    def hasAttribute(self, name):
+        return self._key(name) in self.element.attrib
+
+    def getAttribute(self, name):
+        return etree_text(self.element.get(self._key(name), ''))
+
+    def toxml(self):
+        return tostring(self.element,
+                        self.ownerDocument.namespaces_at(self))
+
+class EtreeDocument(EtreeNode):
+    """A document node wrapping an ElementTree element as its root.
+
+    'namespaces' maps the prefixes in scope at the root element to their
+    URIs, with '' for the default namespace; ElementTree does not keep the
+    declarations in the tree itself.  'scopes' maps the elements below the
+    root that declare namespaces of their own to the prefixes in scope at
+    them, so that fragments rooted at or below them resolve names as the
+    source document did.
+
+    """
+    nodeType = EtreeNode.DOCUMENT_NODE
+
+    def __init__(self, root, namespaces=None, scopes=None):
+        self.namespaces = namespaces or {}
+        self.scopes = scopes or {}
+        self.documentElement = EtreeElement(root, self, 0)
+        self.childNodes = [self.documentElement]
+
+    @classmethod
+    def fromstring(cls, text):
+        """Parse an XML string with the C ElementTree parser.  The parser
+        drops comments and processing instructions."""
+        return cls.fromfile(StringIO(text))
+
+    @classmethod
+    def fromfile(cls, source):
+        """Parse an XML document from a file object or file name with the C
+        ElementTree parser, reading it in chunks."""
+        root = None
+        scopes = {}
+        parents = []
+        for event, element, namespaces in iterparse_scoped(source):
+            if event == 'end':
+                parents.pop()
+                continue
+            if root is None:
+                root, root_namespaces = element, namespaces
+            elif namespaces is not parents[-1]:
+                scopes[element] = namespaces
+            parents.append(namespaces)
+        return cls(root, root_namespaces, scopes)
+
+    def namespaces_at(self, node):
+        """Return the prefixes in scope at an element of this document."""
+        if self.scopes:
+            while node.nodeType == node.ELEMENT_NODE:
+                if node.element in self.scopes:
+                    return self.scopes[node.element]
+                node = node.parentNode
+        return self.namespaces
+
+    def fragment(self, node):
+        """Return a document rooted at an element of this document, sharing
+        its tree rather than copying it."""
+        return EtreeDocument(node.element, self.namespaces_at(node),
+                             self.scopes)
+
+    def reset(self):
+        """Discard the wrappers and ID index built for the tree so far, so
+        that changes made to the tree since are seen."""
+        self.documentElement = EtreeElement(self.documentElement.element,
+                                            self, 0)
+        self.childNodes = [self.documentElement]
+        self.__dict__.pop('_id_indexes', None)
+
+    def getElementById(self, id):
+        # ElementTree keeps no attribute type information, but xml:id
+        # attributes are IDs whatever the document type.
+        entry = id_index(self, ('xml:id',)).get(id)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def toxml(self):
+        return self.documentElement.toxml()
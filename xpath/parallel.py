@@ -0,0 +1,69 @@
+"""Evaluation of XPath expressions over many documents in a process pool.
+
+The pure python engine is CPU bound, so batch jobs applying the same
+expression to many documents gain from spreading the parsing and evaluation
+across processes.  The expression is sent to each worker once, when the
+worker starts, and only document text and results cross the process
+boundary afterwards.
+
+"""
+from collections import deque
+import multiprocessing
+from xml.dom import minidom
+
+import xpath
+
+def imap(func, items, initializer=None, initargs=(), workers=None,
+         max_pending=None):
+    """Apply func to each item in a process pool, yielding the results in
+    input order.
+
+    At most max_pending items (by default twice the number of workers) are
+    submitted ahead of the result being yielded, so items are pulled from
+    the iterable lazily and memory use stays bounded.
+
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = 2 * workers
+    pool = multiprocessing.Pool(workers, initializer, initargs)
+    try:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+_worker_xpath = None
+_worker_kwargs = None
+
+def _init_worker(expr, kwargs):
+    global _worker_xpath, _worker_kwargs
+    _worker_xpath = xpath.XPath.get(expr)
+    _worker_kwargs = kwargs
+
+def _find_in_worker(document):
+    node = minidom.parseString(document)
+    result = _worker_xpath.find(node, **_worker_kwargs)
+    if xpath.expr.nodesetp(result):
+        return [xpath.expr.string_value(x) for x in result]
+    return result
+
+def findmany(expr, documents, workers=None, max_pending=None, **kwargs):
+    """Evaluate expr against each of the XML strings in documents.
+
+    Yields one result per document, in input order.  Node-sets are returned
+    as lists of node string-values, since DOM nodes cannot be shared between
+    processes; other results are returned unchanged.  Keyword arguments are
+    used to build the evaluation context, as for find().
+
+    """
+    return imap(_find_in_worker, documents, _init_worker, (str(expr), kwargs),
+                workers, max_pending)
@@ -0,0 +1,159 @@
+"""Per-node profiling of XPath expression evaluation.
+
+A Profile instruments every node of a parsed expression, recording how
+often it was evaluated, how many nodes it examined and returned, and the
+cumulative time spent in it.  Profile.explain() renders the expression
+tree annotated with those figures.
+
+"""
+import time
+
+import xpath.expr as X
+
+class NodeStats(object):
+    """Counters for a single expression node."""
+
+    def __init__(self):
+        self.calls = 0
+        self.visited = 0
+        self.emitted = 0
+        self.time = 0.0
+
+def children(expr):
+    """Return the sub-expressions of an expression node."""
+    if isinstance(expr, X.BinaryOperatorExpr):
+        return [expr.left, expr.right]
+    if isinstance(expr, X.NegationExpr):
+        return [expr.expr]
+    if isinstance(expr, X.AbsolutePathExpr):
+        if expr.path is None:
+            return []
+        return [expr.path]
+    if isinstance(expr, X.PathExpr):
+        return list(expr.steps)
+    if isinstance(expr, X.PredicateList):
+        return [expr.expr] + list(expr.predicates)
+    if isinstance(expr, X.Function):
+        return list(expr.args)
+    return []
+
+def plan(expr, depth=0):
+    """Render an expression tree, one node per line."""
+    lines = ['%s%s %s' % ('  ' * depth, expr.__class__.__name__, expr)]
+    for child in children(expr):
+        lines.append(plan(child, depth + 1))
+    return '\n'.join(lines)
+
+def _counting_axis(axis, stats):
+    def walk(node):
+        for n in axis(node):
+            stats.visited += 1
+            yield n
+    walk.__name__ = axis.__name__
+    walk.reverse = axis.reverse
+    walk.principal_node_type = axis.principal_node_type
+    return walk
+
+def _counting_lookup(lookup, stats):
+    # A step answered by lookup examines only the nodes it finds.
+    def counted(node, context):
+        match = lookup(node, context)
+        if match is not None:
+            stats.visited += len(match)
+        return match
+    return counted
+
+def _counting_nodes(nodes, stats):
+    while True:
+        start = time.time()
+        try:
+            n = next(nodes)
+        except StopIteration:
+            return
+        finally:
+            stats.time += time.time() - start
+        stats.emitted += 1
+        yield n
+
+class Profile(object):
+    """Instruments an expression tree in place.
+
+    The tree should not be shared with unprofiled expressions, since the
+    evaluate method of every node is replaced.
+
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        self.stats = {}
+        self._instrument(expr)
+
+    def _instrument(self, expr):
+        stats = self.stats[id(expr)] = NodeStats()
+        for child in children(expr):
+            self._instrument(child)
+
+        if isinstance(expr, X.AxisStep):
+            expr.axis = _counting_axis(expr.axis, stats)
+            if expr.lookup is not None:
+                expr.lookup = _counting_lookup(expr.lookup, stats)
+        child_stats = None
+        if isinstance(expr, X.PredicateList):
+            child_stats = self.stats[id(expr.expr)]
+
+        evaluate = expr.evaluate
+        def profiled(node, pos, size, context):
+            stats.calls += 1
+            if child_stats is not None:
+                before = child_stats.emitted
+            start = time.time()
+            try:
+                result = evaluate(node, pos, size, context)
+            finally:
+                stats.time += time.time() - start
+            if child_stats is not None:
+                stats.visited += child_stats.emitted - before
+            if X.nodesetp(result):
+                stats.emitted += len(result)
+            return result
+        expr.evaluate = profiled
+
+        # count(), sum() and boolean() walk location paths through
+        # iter_nodes rather than evaluate.  When a path cannot be walked
+        # lazily they fall back to evaluate, which is counted above.
+        if isinstance(expr, X.LocationPath):
+            iter_nodes = expr.iter_nodes
+            def profiled_iter_nodes(node, pos, size, context):
+                start = time.time()
+                try:
+                    nodes = iter_nodes(node, pos, size, context)
+                finally:
+                    stats.time += time.time() - start
+                if nodes is None:
+                    return None
+                stats.calls += 1
+                return _counting_nodes(nodes, stats)
+            expr.iter_nodes = profiled_iter_nodes
+
+    def reset(self):
+        """Zero all counters."""
+        for stats in self.stats.values():
+            NodeStats.__init__(stats)
+
+    def explain(self):
+        """Render the expression tree annotated with the profile counters."""
+        lines = ['%8s %8s %8s %10s  %s' %
+                 ('calls', 'visited', 'emitted', 'time(ms)', 'expression')]
+        self._explain(self.expr, 0, lines)
+        return '\n'.join(lines)
+
+    def _explain(self, expr, depth, lines):
+        stats = self.stats[id(expr)]
+        if isinstance(expr, (X.AxisStep, X.PredicateList)):
+            visited = str(stats.visited)
+        else:
+            visited = '-'
+        lines.append('%8d %8s %8d %10.3f  %s%s %s' %
+                     (stats.calls, visited, stats.emitted, stats.time * 1000,
+                      '  ' * depth, expr.__class__.__name__, expr))
+        for child in children(expr):
+            self._explain(child, depth + 1, lines)
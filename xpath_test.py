@@ -0,0 +1,354 @@
+"""
+Copyright 2009 Chris Tarttelin and Point2 Technologies
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+Redistributions in binary form must reproduce the above copyright notice, this list
+of conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE FREEBSD PROJECT ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE FREEBSD PROJECT OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of the FreeBSD Project.
+"""
+
+import unittest, gc, weakref
+from xml.dom import minidom
+import xpath
+
+DOC = minidom.parseString(
+    '<Person Name="Fred">'
+    '<Addresses>'
+    '<Address type="home"><Street>1 Elm St</Street><City>Calgary</City></Address>'
+    '<Address type="work"><Street>2 Oak Ave</Street><City>Regina</City></Address>'
+    '</Addresses>'
+    '<Nicknames><Name>Freddo</Name><Name>Fr</Name></Nicknames>'
+    '</Person>')
+
+class XPathBatchTest(unittest.TestCase):
+
+    def assertSameAsFind(self, exprs, node=DOC):
+        results = xpath.findbatch(exprs, node)
+        self.assertEquals(len(exprs), len(results))
+        for expr, result in zip(exprs, results):
+            self.assertEquals(xpath.find(expr, node), result, expr)
+
+    def test_batch_matches_individual_evaluation_for_shared_prefixes(self):
+        self.assertSameAsFind(['/Person/@Name',
+                               '/Person/Addresses/Address/Street',
+                               '/Person/Addresses/Address/City',
+                               '/Person/Addresses/Address/@type',
+                               '/Person/Nicknames/Name'])
+
+    def test_batch_handles_predicates_descendants_and_duplicates(self):
+        self.assertSameAsFind(['/Person/Addresses/Address[2]/City',
+                               '/Person/Addresses/Address[@type="home"]/Street',
+                               '//City',
+                               '/Person/Addresses/Address[2]/City',
+                               '/'])
+
+    def test_batch_evaluates_relative_paths_from_the_context_node(self):
+        address = xpath.findnode('/Person/Addresses/Address[2]', DOC)
+        self.assertSameAsFind(['Street', 'City', '../Address/@type', '/Person/@Name'], address)
+
+    def test_batch_evaluates_non_path_expressions(self):
+        self.assertSameAsFind(['count(/Person/Addresses/Address)',
+                               'string(/Person/@Name)',
+                               '/Person/Nicknames/Name'])
+
+    def test_batch_results_are_independent_lists(self):
+        first, second = xpath.findbatch(['/Person', '/Person'], DOC)
+        first.append(None)
+        self.assertEquals(1, len(second))
+
+    def test_batch_is_cached(self):
+        exprs = ['/Person/@Name', '/Person/Nicknames/Name']
+        self.assertTrue(xpath.XPathBatch.get(exprs) is xpath.XPathBatch.get(list(exprs)))
+
+NS_DOC = minidom.parseString(
+    '<root xmlns="urn:default" xmlns:p="urn:p" p:id="1" id="2">'
+    '<item/><p:item/><p:other/><item p:id="3"/>'
+    '</root>')
+
+class NameTestTest(unittest.TestCase):
+
+    def names(self, expr, **kwargs):
+        return [(n.namespaceURI, n.localName) for n in xpath.find(expr, NS_DOC, **kwargs)]
+
+    def test_unprefixed_names_match_the_default_namespace(self):
+        self.assertEquals([('urn:default', 'item'), ('urn:default', 'item')], self.names('/root/item'))
+
+    def test_prefixed_names_match_the_bound_namespace(self):
+        self.assertEquals([('urn:p', 'item')], self.names('/root/p:item'))
+
+    def test_prefix_wildcard_matches_all_names_in_namespace(self):
+        self.assertEquals([('urn:p', 'item'), ('urn:p', 'other')], self.names('/root/p:*'))
+
+    def test_wildcard_matches_only_elements(self):
+        self.assertEquals(4, len(self.names('/root/*')))
+
+    def test_unprefixed_attribute_names_have_no_namespace(self):
+        self.assertEquals([(None, 'id')], self.names('/root/@id'))
+        self.assertEquals([('urn:p', 'id')], self.names('/root/@p:id'))
+
+    def test_same_expression_resolves_prefix_per_context(self):
+        self.assertEquals([], self.names('/root/p:item', namespaces={'p': 'urn:other'}))
+        self.assertEquals([('urn:p', 'item')], self.names('/root/p:item'))
+
+    def test_matchers_are_kept_for_a_bounded_number_of_namespaces(self):
+        test = xpath.expr.NameTest('p', 'item')
+        child = xpath.expr.axes['child']
+        for i in range(3 * test._max_matchers):
+            test.matcher(child, xpath.XPathContext(namespaces={'p': 'urn:other:%d' % i}))
+            self.assertTrue(len(test._matchers) <= test._max_matchers + 1)
+        match = test.matcher(child, xpath.XPathContext(namespaces={'p': 'urn:p'}))
+        self.assertTrue(match(NS_DOC.documentElement.childNodes[1]))
+
+    def test_unknown_prefix_raises(self):
+        self.assertRaises(xpath.XPathUnknownPrefixError, xpath.find, '/root/q:item', NS_DOC)
+
+class LookupTest(unittest.TestCase):
+
+    def test_named_attribute_step_finds_attribute(self):
+        self.assertEquals(['Fred'], [a.value for a in xpath.find('/Person/@Name', DOC)])
+        self.assertEquals(['home', 'work'], [a.value for a in xpath.find('//Address/@type', DOC)])
+
+    def test_named_attribute_step_on_non_elements_and_missing_names(self):
+        self.assertEquals([], xpath.find('/@Name', DOC))
+        self.assertEquals([], xpath.find('/Person/Nicknames/Name/text()/@Name', DOC))
+        self.assertEquals([], xpath.find('/Person/@Missing', DOC))
+
+    def test_named_attribute_step_respects_namespaces(self):
+        self.assertEquals(['1'], [a.value for a in xpath.find('/root/@p:id', NS_DOC)])
+        self.assertEquals(['2'], [a.value for a in xpath.find('/root/@id', NS_DOC)])
+        self.assertEquals(['3'], [a.value for a in xpath.find('/root/item/@p:id', NS_DOC)])
+
+    def test_batch_child_lookups_match_individual_evaluation(self):
+        exprs = ['/root/item', '/root/p:item', '/root/p:other', '/root/missing', '/root/item/@p:id']
+        results = xpath.findbatch(exprs, NS_DOC)
+        self.assertEquals([xpath.find(expr, NS_DOC) for expr in exprs], results)
+
+    def test_batch_child_lookup_results_are_independent_lists(self):
+        first, second = xpath.findbatch(['/root/item', '/root/item[1]'], NS_DOC)
+        first.pop()
+        self.assertEquals(2, len(xpath.findbatch(['/root/item', '/root/p:item'], NS_DOC)[0]))
+
+AGG_DOC = minidom.parseString(
+    '<Order>'
+    '<Line qty="2"><Price>1.5</Price><Tag/></Line>'
+    '<Line qty="3"><Price>2</Price></Line>'
+    '<Line qty="x"><Price>4</Price><Line qty="5"><Price>8</Price></Line></Line>'
+    '</Order>')
+
+class AggregateTest(unittest.TestCase):
+
+    def assertSameAsNodeSet(self, function, expr):
+        # Evaluate the aggregate through a node-set built by a union with
+        # the empty set, which is never pushed down.
+        pushed = xpath.find('%s(%s)' % (function, expr), AGG_DOC)
+        materialized = xpath.find('%s(%s | /nothing)' % (function, expr), AGG_DOC)
+        if pushed != pushed:
+            self.assertTrue(materialized != materialized, expr)
+        else:
+            self.assertEquals(materialized, pushed, expr)
+
+    def test_count_matches_node_set_evaluation(self):
+        for expr in ['/Order/Line', '//Line', '//Line/Price', '//Price/..', '//Line/@qty',
+                     '//Line[Tag]', '//Line[not(Tag)]', '/Order/Missing', '/', '//node()']:
+            self.assertSameAsNodeSet('count', expr)
+
+    def test_sum_matches_node_set_evaluation(self):
+        for expr in ['/Order/Line/Price', '//Price', '//Price/ancestor::Line/Price', '//Line/@qty', '/Order/Missing']:
+            self.assertSameAsNodeSet('sum', expr)
+
+    def test_boolean_and_not_match_node_set_evaluation(self):
+        for function in ['boolean', 'not']:
+            for expr in ['//Tag', '/Order/Tag', '//Line[Tag]/Price', '/']:
+                self.assertSameAsNodeSet(function, expr)
+
+    def test_path_predicates_and_boolean_operators(self):
+        self.assertEquals(1, len(xpath.find('/Order/Line[Tag]', AGG_DOC)))
+        self.assertEquals(3, len(xpath.find('//Line[Price and not(Tag)]', AGG_DOC)))
+        self.assertEquals(3, len(xpath.find('/Order/Line[Tag or Price]', AGG_DOC)))
+
+    def test_aggregates_of_non_node_sets(self):
+        self.assertEquals(True, xpath.find('boolean(1)', AGG_DOC))
+        self.assertEquals(True, xpath.find('not("")', AGG_DOC))
+        self.assertRaises(xpath.XPathTypeError, xpath.find, 'count(1)', AGG_DOC)
+        self.assertRaises(xpath.XPathTypeError, xpath.find, 'sum("a")', AGG_DOC)
+
+class ProfileTest(unittest.TestCase):
+
+    def test_profiled_expression_returns_same_result(self):
+        expr = '/Person/Addresses/Address[@type="work"]/City'
+        self.assertEquals(xpath.find(expr, DOC), xpath.XPath(expr, profile=True).find(DOC))
+
+    def test_profile_counts_calls_visited_and_emitted_nodes(self):
+        x = xpath.XPath('/Person/Addresses/Address[@type="work"]', profile=True)
+        x.find(DOC)
+        x.find(DOC)
+        predicates = x.expr.path.steps[-1]
+        stats = x.profile.stats[id(predicates)]
+        self.assertEquals(2, stats.calls)
+        self.assertEquals(4, stats.visited)
+        self.assertEquals(2, stats.emitted)
+        step = x.profile.stats[id(predicates.expr)]
+        self.assertEquals(4, step.visited)
+        self.assertEquals(4, step.emitted)
+
+    def test_profile_counts_aggregated_paths(self):
+        x = xpath.XPath('count(/Person/Addresses/Address)', profile=True)
+        self.assertEquals(2, x.find(DOC))
+        path = x.profile.stats[id(x.expr.steps[0].args[0])]
+        self.assertEquals(1, path.calls)
+        self.assertEquals(2, path.emitted)
+
+    def test_profile_counts_nodes_found_by_lookup(self):
+        x = xpath.XPath('/Person/@Name', profile=True)
+        x.find(DOC)
+        self.assertEquals(1, x.profile.stats[id(x.expr.path.steps[-1])].visited)
+
+    def test_profile_reset_zeroes_counters(self):
+        x = xpath.XPath('count(//Name)', profile=True)
+        x.find(DOC)
+        x.profile.reset()
+        self.assertEquals(0, x.profile.stats[id(x.expr)].calls)
+
+    def test_explain_annotates_each_node(self):
+        plan = xpath.explain('/Person/Nicknames/Name[2]', DOC).splitlines()
+        self.assertTrue('calls' in plan[0])
+        self.assertEquals(9, len(plan))
+        self.assertTrue(plan[-3].strip().endswith('AxisStep child::Name'))
+
+    def test_unprofiled_explain_renders_plan(self):
+        plan = xpath.XPath('/Person/@Name').explain().splitlines()
+        self.assertEquals(['AbsolutePathExpr /child::Person/attribute::Name',
+                           '  PathExpr child::Person/attribute::Name',
+                           '    AxisStep child::Person',
+                           '    AxisStep attribute::Name'], plan)
+
+class EtreeTest(unittest.TestCase):
+
+    TEXT = ('<r xmlns="urn:d" xmlns:p="urn:p" a="1" p:b="2" xml:lang="en">'
+            'head<c>x<d n="1">y</d>tail</c>'
+            '<p:e>z</p:e><c><d n="2"/></c></r>')
+
+    def assertSameAsMinidom(self, expr, **kwargs):
+        expected = xpath.find(expr, minidom.parseString(self.TEXT), **kwargs)
+        result = xpath.find(expr, xpath.parse(self.TEXT), **kwargs)
+        if xpath.expr.nodesetp(expected):
+            expected = [(n.nodeType, xpath.expr.string_value(n)) for n in expected]
+            result = [(n.nodeType, xpath.expr.string_value(n)) for n in result]
+        self.assertEquals(expected, result, expr)
+
+    def test_paths_match_minidom(self):
+        for expr in ['/r/c/d', '//d[@n="2"]', '/r/c[1]/node()', '//text()',
+                     '/r/@p:b',
+                     '//d/following::*', '//d/preceding-sibling::node()',
+                     '/r/p:e', '//*[local-name()="e"]', 'count(//c/d)', 'string(/r)']:
+            self.assertSameAsMinidom(expr)
+
+    def test_namespaces_declared_in_the_document_are_used(self):
+        self.assertEquals(['z'], xpath.findvalues('/r/p:e', xpath.parse(self.TEXT)))
+        self.assertEquals(2, len(xpath.find('/r/c', xpath.parse(self.TEXT))))
+
+    def test_namespaces_declared_below_the_root_are_scoped_to_their_element(self):
+        text = '<a><b xmlns="urn:x"><c>1</c></b><d>2</d></a>'
+        doc = xpath.parse(text)
+        self.assertEquals(len(xpath.find('/a/d', minidom.parseString(text))), len(xpath.find('/a/d', doc)))
+        self.assertEquals([u'2'], xpath.findvalues('/a/d', doc))
+        fragment = doc.fragment(xpath.findnode('/a/*[1]', doc))
+        self.assertEquals([u'1'], xpath.findvalues('/b/c', fragment))
+
+    def test_text_values_are_unicode(self):
+        doc = xpath.parse('<a x="1">text</a>')
+        self.assertTrue(isinstance(xpath.findvalue('/a', doc), unicode))
+        self.assertTrue(isinstance(xpath.findvalue('/a/@x', doc), unicode))
+
+    def test_nodes_serialize_to_xml(self):
+        doc = xpath.parse('<a x="&quot;1&quot;"><b>1 &lt; 2</b>tail<b/></a>')
+        self.assertEquals('<b>1 &lt; 2</b>', xpath.findnode('/a/b', doc).toxml())
+        self.assertEquals('x="&quot;1&quot;"', xpath.findnode('/a/@x', doc).toxml())
+
+    def test_fragment_shares_the_tree_and_is_rooted_at_the_element(self):
+        doc = xpath.parse(self.TEXT)
+        second = xpath.find('/r/c', doc)[1]
+        fragment = doc.fragment(second)
+        self.assertTrue(fragment.documentElement.element is second.element)
+        self.assertEquals(['2'], xpath.findvalues('/c/d/@n', fragment))
+        self.assertEquals([], xpath.find('/r', fragment))
+
+class IdTest(unittest.TestCase):
+
+    TEXT = ('<r><p id="a" ref="c"/><p id="b" ref="a c"/>'
+            '<q xml:id="c" ref="b"><p id="a"/></q></r>')
+
+    def ids(self, expr, doc, **kwargs):
+        return [n.getAttribute('id') or n.getAttribute('xml:id')
+                for n in xpath.find(expr, doc, **kwargs)]
+
+    def test_id_attributes_are_looked_up_in_document_order(self):
+        for doc in [minidom.parseString(self.TEXT), xpath.parse(self.TEXT)]:
+            self.assertEquals(['a', 'b', 'c'], self.ids('id("c b a c")', doc, id_attributes=['id', 'xml:id']))
+            self.assertEquals(['c'], self.ids('id(/r/p/@ref)', doc, id_attributes=['xml:id']))
+            self.assertEquals([], self.ids('id("x")', doc, id_attributes=['id']))
+
+    def test_id_in_predicates_follows_references(self):
+        doc = xpath.parse(self.TEXT)
+        self.assertEquals(['b'], self.ids('//*[id(@ref)/@xml:id="c" and id(@ref)/@id="a"]', doc,
+                                          id_attributes=['id', 'xml:id']))
+
+    def test_first_element_with_an_id_wins(self):
+        doc = minidom.parseString(self.TEXT)
+        self.assertEquals(['p'], [n.tagName for n in xpath.find('id("a")', doc, id_attributes=['id'])])
+        self.assertTrue(xpath.findnode('id("a")', doc, id_attributes=['id']) is doc.documentElement.firstChild)
+
+    def test_index_is_built_once_per_document(self):
+        doc = xpath.parse(self.TEXT)
+        index = xpath.expr.id_index(doc, ['id'])
+        self.assertTrue(xpath.expr.id_index(doc, ('id',)) is index)
+        self.assertEquals(['a', 'b'], sorted(index))
+
+    def test_indexed_documents_can_be_collected(self):
+        refs = []
+        for parse in [minidom.parseString, xpath.parse]:
+            doc = parse(self.TEXT)
+            self.assertEquals(['a'], self.ids('id("a")', doc, id_attributes=['id']))
+            refs.append(weakref.ref(doc))
+            del doc
+        gc.collect()
+        self.assertEquals([None, None], [ref() for ref in refs])
+
+    def test_xml_id_is_an_id_by_default_for_parsed_documents(self):
+        self.assertEquals(['c'], self.ids('id("c")', xpath.parse(self.TEXT)))
+
+class FindManyTest(unittest.TestCase):
+
+    def test_findmany_returns_results_in_input_order(self):
+        documents = ['<a><b>%d</b><b>x</b></a>' % i for i in range(20)]
+        results = list(xpath.findmany('/a/b', documents, workers=2, max_pending=3))
+        self.assertEquals([[u'%d' % i, u'x'] for i in range(20)], results)
+
+    def test_findmany_returns_non_node_set_results_unchanged(self):
+        results = list(xpath.findmany('count(/a/b)', ['<a/>', '<a><b/></a>'], workers=2))
+        self.assertEquals([0, 1], results)
+
+    def test_findmany_raises_evaluation_errors(self):
+        self.assertRaises(xpath.XPathUnknownPrefixError, list, xpath.findmany('/q:a', ['<a/>'], workers=1))
+
+if __name__=='__main__':
+    unittest.main()